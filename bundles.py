@@ -0,0 +1,122 @@
+# bundles.py
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from file_cache import attachment_cache
+from spooling import CHUNK_SIZE, close_files
+
+# 同时打包的线程数与 deflate 压缩级别
+BUNDLE_WORKERS = 2
+BUNDLE_COMPRESS_LEVEL = 6
+
+_pool = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # 用线程而不是子进程：zlib 压缩和 CRC 计算期间会释放 GIL，不会卡住事件循环；
+        # 子进程（spawn）会重新执行 main.py 的启动代码，进程池一旦损坏还会让之后的打包全部失败
+        _pool = ThreadPoolExecutor(max_workers=BUNDLE_WORKERS, thread_name_prefix="bundle")
+    return _pool
+
+def close_pool():
+    """Bot 关闭时调用，放弃还没开始的打包任务（正在压缩的会做完）"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def bundle_key(file_data):
+    """由文件列表（顺序、文件名、内容或引用）算出打包缓存键；改名、换文件后键随之变化"""
+    parts = [[f.get('filename'), f.get('content_hash') or attachment_cache.key_for(f) or f.get('url')] for f in file_data]
+    return "zip_" + hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+def bundle_filename(title):
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', title or "").strip('_')[:80]
+    return f"{name or 'attachments'}.zip"
+
+def _arcnames(filenames):
+    """压缩包内的文件名，同名文件加序号区分"""
+    seen, names = {}, []
+    for name in filenames:
+        name = os.path.basename(name or "") or "file"
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem} ({count + 1}){ext}"
+        names.append(name)
+    return names
+
+def _build_zip(entries, out_path, level):
+    """在打包线程里执行：把 [(源文件路径, 包内文件名), ...] 写成 zip，返回字节数"""
+    with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+        for path, arcname in entries:
+            zf.write(path, arcname)
+    return os.path.getsize(out_path)
+
+def _stage_inputs(file_results, tmp_dir):
+    """把内存/匿名临时文件里的内容落到目录里，打包时按路径读取，不占用调用方的文件句柄"""
+    entries = []
+    for i, (res, arcname) in enumerate(zip(file_results, _arcnames([r['filename'] for r in file_results]))):
+        path = os.path.join(tmp_dir, str(i))
+        res['fp'].seek(0)
+        with open(path, "wb") as out: shutil.copyfileobj(res['fp'], out, CHUNK_SIZE)
+        res['fp'].seek(0)
+        entries.append((path, arcname))
+    return entries
+
+class BundleBuilder:
+    """
+    保护贴的 zip 打包：结果存进附件磁盘缓存（键见 bundle_key），压缩在专用线程池里进行，不阻塞事件循环。
+    同一个键的并发请求只打包一次。
+    """
+    def __init__(self):
+        self._building = {}  # 键 -> 正在进行的打包任务
+
+    async def open(self, key, fetch):
+        """
+        返回打包好的 zip 文件句柄（调用方负责关闭），失败返回 None。
+        fetch 是无参协程函数，缓存未命中时调用，返回 [{'filename', 'fp'}]；打包完会关闭这些文件。
+        """
+        fp = await attachment_cache.open(key)
+        if fp: return fp
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._build(key, fetch))
+            self._building[key] = task
+        if not await asyncio.shield(task): return None
+        return await attachment_cache.open(key)
+
+    async def _build(self, key, fetch):
+        file_results = []
+        tmp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bundle-")
+        try:
+            file_results = await fetch()
+            if not file_results: return False
+            entries = await asyncio.to_thread(_stage_inputs, file_results, tmp_dir)
+            close_files(file_results)
+            out_path = os.path.join(tmp_dir, "bundle.zip")
+            size = await asyncio.get_running_loop().run_in_executor(_get_pool(), _build_zip, entries, out_path, BUNDLE_COMPRESS_LEVEL)
+            with open(out_path, "rb") as src:
+                return bool(await attachment_cache.put_file(key, src, size))
+        except Exception as e:
+            print(f"Bundle Error: {e}")
+            return False
+        finally:
+            close_files(file_results)
+            self._building.pop(key, None)
+            await asyncio.to_thread(shutil.rmtree, tmp_dir, True)
+
+    async def discard(self, key):
+        await attachment_cache.discard(key)
+
+bundle_builder = BundleBuilder()
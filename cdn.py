@@ -0,0 +1,105 @@
+# cdn.py
+
+import asyncio
+import time
+from urllib.parse import urlparse, parse_qs
+
+from discord.http import Route
+
+# 签名链接离过期不足这么多秒就视为已过期，留出下载所需的时间
+URL_EXPIRY_MARGIN = 300
+# 链接里没有 ex= 参数时的缓存时长（秒）
+URL_DEFAULT_TTL = 3600
+# 缓存条目上限，超过时先清理已过期的条目
+URL_CACHE_MAX_ENTRIES = 10000
+# refresh-urls 接口单次最多接受的链接数
+REFRESH_BATCH_SIZE = 50
+
+def url_expires_at(url):
+    """解析 Discord CDN 签名链接的 ex= 参数（十六进制 Unix 时间戳），没有则返回 None"""
+    try:
+        ex = parse_qs(urlparse(url).query).get('ex')
+        return int(ex[0], 16) if ex else None
+    except (ValueError, TypeError):
+        return None
+
+def url_is_fresh(url, margin=URL_EXPIRY_MARGIN):
+    """签名链接在 margin 秒之后仍然有效才算新鲜；没有 ex= 的旧式链接视为不新鲜"""
+    expires_at = url_expires_at(url) if url else None
+    return bool(expires_at) and expires_at - margin > time.time()
+
+async def refresh_attachment_urls(http, urls):
+    """
+    通过 POST /attachments/refresh-urls 批量刷新过期的附件链接，每批最多 REFRESH_BATCH_SIZE 条。
+    http 是 bot.http（discord.py 的 HTTPClient，自带鉴权与限速处理），返回 {原链接: 新链接}。
+    """
+    refreshed = {}
+    urls = list(dict.fromkeys(urls))
+    for i in range(0, len(urls), REFRESH_BATCH_SIZE):
+        batch = urls[i:i + REFRESH_BATCH_SIZE]
+        data = await http.request(Route('POST', '/attachments/refresh-urls'), json={'attachment_urls': batch})
+        for entry in (data or {}).get('refreshed_urls', []):
+            if entry.get('original') and entry.get('refreshed'):
+                refreshed[entry['original']] = entry['refreshed']
+    return refreshed
+
+class AttachmentURLCache:
+    """
+    备份消息 (channel_id, message_id) -> 附件列表 [(url, size), ...] 的进程级缓存。
+    条目在签名链接过期前失效；同一条消息的并发查询合并成一次 loader 调用。
+    """
+    def __init__(self, max_entries=URL_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = {}   # key -> (失效时间, 附件列表)
+        self._inflight = {}  # key -> 正在进行的加载任务
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "entries": len(self._entries)}
+
+    def put(self, key, attachments):
+        expiries = [url_expires_at(url) for url, _ in attachments]
+        expiries = [ex for ex in expiries if ex]
+        valid_until = (min(expiries) if expiries else time.time() + URL_DEFAULT_TTL) - URL_EXPIRY_MARGIN
+        if valid_until <= time.time(): return
+        if len(self._entries) >= self.max_entries: self._prune()
+        self._entries[key] = (valid_until, list(attachments))
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def _prune(self):
+        now = time.time()
+        for key in [k for k, (valid_until, _) in self._entries.items() if valid_until <= now]:
+            del self._entries[key]
+        # 仍然超限就丢掉最早写入的一半
+        if len(self._entries) >= self.max_entries:
+            for key in list(self._entries)[:len(self._entries) // 2]:
+                del self._entries[key]
+
+    async def get(self, key, loader):
+        """loader 是无参协程函数，返回附件列表或 None（失败结果不缓存）"""
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task: self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._inflight[key] = task
+        # shield：某个等待者被取消时不影响其他合并进来的请求
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        try:
+            attachments = await loader()
+            if attachments is not None: self.put(key, attachments)
+            return attachments
+        finally:
+            self._inflight.pop(key, None)
+
+attachment_url_cache = AttachmentURLCache()
@@ -4,6 +4,9 @@ from discord.ext import commands, tasks
 from datetime import datetime, time
 import asyncio
 from zoneinfo import ZoneInfo
+from scheduler import scheduler
+from thread_index import thread_index
+from starter_cache import starter_cache
 try:
     from utils import chimidan_text
 except ImportError:
@@ -13,6 +16,13 @@ except ImportError:
 TARGET_CHANNEL_IDS = [1450863242179121162, 1450863444373798922, 1451245427444814047]
 ADMIN_USER_ID = 1353777207042113576
 TZ_SHANGHAI = ZoneInfo("Asia/Shanghai")
+# 启动时建搜索索引，同时拉取首楼内容的并发数
+THREAD_INDEX_CONCURRENCY = 8
+# 归档帖爬取：每隔多少分钟跑一轮，每轮所有论坛合计最多收录多少个（每 100 个是一次 API 请求）
+ARCHIVE_CRAWL_INTERVAL_MINUTES = 10
+ARCHIVE_CRAWL_BUDGET = 2000
+# 归档帖存活检查：每轮所有论坛合计最多确认多少个（每个是一次 API 请求）
+ARCHIVE_VERIFY_BUDGET = 200
 
 # ==========================================
 # Part 1. 通用分页视图
@@ -26,7 +36,8 @@ class PaginatorView(ui.View):
         self.is_daily = is_daily
         self.per_page = 10
         self.current_page = 0
-        self.total_pages = (len(data_list) - 1) // self.per_page + 1 if data_list else 1
+        self.total_count = len(data_list)
+        self.total_pages = (self.total_count - 1) // self.per_page + 1 if self.total_count else 1
         self.update_buttons()
 
     def update_buttons(self):
@@ -34,19 +45,25 @@ class PaginatorView(ui.View):
         self.next_btn.disabled = (self.current_page >= self.total_pages - 1)
         self.page_counter.label = f"第 {self.current_page + 1} / {self.total_pages} 页"
 
-    def get_embed(self):
+    def page_items(self):
         start = self.current_page * self.per_page
-        end = start + self.per_page
-        page_items = self.data_list[start:end]
+        return self.data_list[start:start + self.per_page]
+
+    async def load_page(self):
+        """翻页前调用，子类可以在这里按需加载当前页"""
+        pass
+
+    def get_embed(self):
+        page_items = self.page_items()
 
         desc_text = ""
         if self.is_daily:
-            if not self.data_list:
+            if not self.total_count:
                 desc_text = chimidan_text("今天好安静唷，还没有新帖子捏... 🈚️")
             else:
-                desc_text = chimidan_text(f"哇！今天全服新增了 {len(self.data_list)} 个有趣的帖子！")
+                desc_text = chimidan_text(f"哇！今天全服新增了 {self.total_count} 个有趣的帖子！")
         else:
-            if not self.data_list:
+            if not self.total_count:
                 desc_text = chimidan_text("没有找到相关结果捏...")
         
         embed = discord.Embed(title=self.title, description=desc_text, color=0xffa07a if self.is_daily else 0x98fb98)
@@ -70,13 +87,14 @@ class PaginatorView(ui.View):
             time_str = datetime.now(TZ_SHANGHAI).strftime('%H:%M')
             embed.set_footer(text=f"最后更新于: {time_str} (每10分钟刷新)")
         else:
-            embed.set_footer(text=f"共找到 {len(self.data_list)} 个结果 | 翻页看更多来捉")
+            embed.set_footer(text=f"共找到 {self.total_count} 个结果 | 翻页看更多来捉")
         return embed
 
     @ui.button(emoji="⬅️", style=discord.ButtonStyle.secondary, custom_id="paginator_prev")
     async def prev_btn(self, interaction: discord.Interaction, button: ui.Button):
         if self.current_page > 0:
             self.current_page -= 1
+            await self.load_page()
             self.update_buttons()
             await interaction.response.edit_message(embed=self.get_embed(), view=self)
 
@@ -88,9 +106,26 @@ class PaginatorView(ui.View):
     async def next_btn(self, interaction: discord.Interaction, button: ui.Button):
         if self.current_page < self.total_pages - 1:
             self.current_page += 1
+            await self.load_page()
             self.update_buttons()
             await interaction.response.edit_message(embed=self.get_embed(), view=self)
 
+class SearchPaginatorView(PaginatorView):
+    """搜索结果分页：排序和分页都交给数据库，每次只查当前页的帖子"""
+    def __init__(self, guild, query, title):
+        super().__init__([], title, is_daily=False)
+        self.guild = guild
+        self.query = query   # thread_index.search 的筛选参数
+        self.page = []
+
+    def page_items(self):
+        return self.page
+
+    async def load_page(self):
+        ids, self.total_count = await thread_index.search(**self.query, limit=self.per_page, offset=self.current_page * self.per_page)
+        self.page = await thread_index.load(self.guild, ids)
+        self.total_pages = (self.total_count - 1) // self.per_page + 1 if self.total_count else 1
+        self.update_buttons()
 
 # ==========================================
 # Part 2. 搜索逻辑 (更新：支持标签筛选)
@@ -98,89 +133,43 @@ class PaginatorView(ui.View):
 
 async def execute_search(interaction: discord.Interaction, search_type: str, query_data, selected_channels, selected_tag_ids=None):
     await interaction.response.send_message(
-        chimidan_text("收到指令惹！正在全速启动搜索引擎... (0%)"), 
+        chimidan_text("收到指令惹！正在全速启动搜索引擎..."), 
         ephemeral=True
     )
     
-    # 确定搜索范围
-    target_forums = selected_channels if selected_channels else interaction.guild.forums
-    
-    # 收集所有帖子
-    all_threads = []
-    for forum in target_forums:
-        if isinstance(forum, discord.ForumChannel):
-            all_threads.extend(forum.threads)
+    # 确定搜索范围 (下拉框给的是 AppCommandChannel，只取 ID)
+    guild = interaction.guild
+    forum_ids = [c.id for c in selected_channels] if selected_channels else [f.id for f in guild.forums]
 
-    total_count = len(all_threads)
+    # 启动同步还没跑完时库里可能只有一部分帖子（全新的库甚至是空的），要提示用户而不是说没有帖子
+    indexing_hint = "" if thread_index.ready else "（搜索库还在建立中，结果可能不全，过一会儿再搜试试）"
+    _, total_count = await thread_index.search(forum_ids=forum_ids, limit=0)
     if total_count == 0:
+        if not thread_index.ready:
+            return await interaction.edit_original_response(content=chimidan_text("搜索库还在建立中，暂时搜不到帖子捏，过一会儿再来试试吧..."))
         return await interaction.edit_original_response(content=chimidan_text("呜呜，当前范围内没有帖子可以搜捏..."))
 
-    sem = asyncio.Semaphore(8) 
-    results = []
-    processed_count = 0
-
-    # 将 selected_tag_ids 转为集合方便计算
-    target_tags_set = set(map(int, selected_tag_ids)) if selected_tag_ids else set()
-
-    async def check_thread(thread):
-        async with sem:
-            try:
-                # 1. 标签筛选 (如果选了标签，必须包含其中至少一个)
-                if target_tags_set:
-                    thread_tag_ids = {tag.id for tag in thread.applied_tags}
-                    # 交集为空，说明该帖子不包含选中的任何标签，跳过
-                    if not (target_tags_set & thread_tag_ids):
-                        return None
-
-                # 2. 核心搜索条件
-                if search_type == "user":
-                    if thread.owner_id == query_data.id:
-                        return thread
-                elif search_type == "keyword":
-                    keyword = query_data.lower()
-                    if keyword in thread.name.lower():
-                        return thread
-                    
-                    # 只有当标题不匹配时，才去翻历史消息（减少API消耗）
-                    starter = thread.starter_message
-                    if not starter:
-                        async for m in thread.history(limit=1, oldest_first=True):
-                            starter = m; break
-                    if starter and starter.content and keyword in starter.content.lower():
-                        return thread
-            except: pass
-            return None
+    # 标签筛选 (如果选了标签，必须包含其中至少一个)，核心搜索条件、排序和分页都在数据库里完成
+    query = {"forum_ids": forum_ids, "tag_ids": list(map(int, selected_tag_ids)) if selected_tag_ids else None}
+    if search_type == "user":
+        query["owner_id"] = query_data.id
+    elif search_type == "keyword":
+        query["keyword"] = query_data
 
-    tasks_list = [check_thread(t) for t in all_threads]
-    last_update_time = datetime.now()
+    paginator = SearchPaginatorView(guild, query, title="")
+    await paginator.load_page()
 
-    for future in asyncio.as_completed(tasks_list):
-        result = await future
-        if result: results.append(result)
-        processed_count += 1
-        
-        now = datetime.now()
-        # 更新进度条 (防止频率限制，每1.5秒或完成时更新)
-        if (now - last_update_time).total_seconds() > 1.5 or processed_count == total_count:
-            percent = int((processed_count / total_count) * 100)
-            try:
-                await interaction.edit_original_response(
-                    content=chimidan_text(f"正在全速搜索中... 咻咻咻！\n进度：{percent}% ({processed_count}/{total_count})\n已找到：{len(results)} 个匹配")
-                )
-                last_update_time = now
-            except: pass
-
-    if not results:
-        return await interaction.edit_original_response(content=chimidan_text(f"呜呜，翻遍了 {total_count} 个帖子也没找到捏..."))
+    if not paginator.total_count:
+        return await interaction.edit_original_response(content=chimidan_text(f"呜呜，翻遍了 {total_count} 个帖子也没找到捏...{indexing_hint}"))
 
     # 生成结果标题
     extra_info = ""
     if selected_tag_ids:
         extra_info = f" (含标签筛选)"
     
-    paginator = PaginatorView(results, title=f"🔍 搜索结果: {len(results)}条{extra_info}", is_daily=False)
+    paginator.title = f"🔍 搜索结果: {paginator.total_count}条{extra_info}"
     await interaction.edit_original_response(
-        content=chimidan_text(f"搜索完成惹！找到以下内容："),
+        content=chimidan_text(f"搜索完成惹！找到以下内容：{indexing_hint}"),
         embed=paginator.get_embed(),
         view=paginator
     )
@@ -312,21 +301,114 @@ class ExplorationCog(commands.Cog):
         self.bot = bot
         self.bot.add_view(SearchMethodView())
         self.daily_task.start()
+        self.index_task = self.bot.loop.create_task(self.build_thread_index())
+        self.archive_crawl_task.start()
     
     async def cog_unload(self):
         self.daily_task.cancel()
+        self.index_task.cancel()
+        self.archive_crawl_task.cancel()
+
+    # --- 帖子搜索索引 ---
+
+    @staticmethod
+    def _is_forum_thread(thread):
+        return isinstance(thread, discord.Thread) and isinstance(thread.parent, discord.ForumChannel)
+
+    async def build_thread_index(self):
+        """启动时逐个论坛同步搜索库，之后靠下面的事件保持同步"""
+        await self.bot.wait_until_ready()
+        sem = asyncio.Semaphore(THREAD_INDEX_CONCURRENCY)
+
+        async def load(thread):
+            async with sem:
+                try: starter = await starter_cache.get(thread)
+                except Exception as e:
+                    print(f"Thread index: failed to load starter of {thread.id}: {e}")
+                    return None
+            return starter.content if starter else ""
+
+        total, fetched = 0, 0
+        for guild in self.bot.guilds:
+            for forum in guild.forums:
+                if not forum.permissions_for(guild.me).read_message_history: continue
+                try: count, loaded = await thread_index.sync_forum(forum, load)
+                except Exception as e:
+                    print(f"Thread index: failed to sync forum {forum.id}: {e}")
+                    continue
+                total += count
+                fetched += loaded
+        thread_index.ready = True
+        print(f"Thread index ready: {total} threads, {fetched} starters fetched")
+
+    @tasks.loop(minutes=ARCHIVE_CRAWL_INTERVAL_MINUTES)
+    async def archive_crawl_task(self):
+        """分批收录归档帖，让搜索、日报和抽卡覆盖整个论坛的历史，并确认已收录的归档帖没有被删除；进度存在库里，重启后接着翻"""
+        budget = ARCHIVE_CRAWL_BUDGET
+        for guild in self.bot.guilds:
+            for forum in guild.forums:
+                if budget <= 0: break
+                if not forum.permissions_for(guild.me).read_message_history: continue
+                try: budget -= await thread_index.crawl_archived(forum, budget)
+                except Exception as e: print(f"Archive crawl failed for forum {forum.id}: {e}")
+        # 归档后被删除的帖子不会出现在归档列表里，另外按预算逐个确认
+        budget = ARCHIVE_VERIFY_BUDGET
+        for guild in self.bot.guilds:
+            for forum in guild.forums:
+                if budget <= 0: return
+                if not forum.permissions_for(guild.me).read_message_history: continue
+                try: budget -= await thread_index.verify_archived(forum, budget)
+                except Exception as e: print(f"Archive verify failed for forum {forum.id}: {e}")
+
+    @archive_crawl_task.before_loop
+    async def before_archive_crawl(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_thread_create(self, thread: discord.Thread):
+        if not self._is_forum_thread(thread): return
+        starter = thread.starter_message
+        await thread_index.upsert(thread, starter.content if starter else None)
+
+    @commands.Cog.listener()
+    async def on_thread_join(self, thread: discord.Thread):
+        # 归档的帖子被重新激活时走的是这个事件
+        if not self._is_forum_thread(thread): return
+        if await thread_index.has_content(thread.id): return await thread_index.upsert(thread)
+        try: starter = await starter_cache.get(thread)
+        except Exception: starter = None
+        await thread_index.upsert(thread, starter.content if starter else None)
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread):
+        if not self._is_forum_thread(after): return
+        # 归档后 discord.py 会把帖子移出缓存，库里标记为归档，照样能搜到
+        starter_cache.invalidate(after.id)
+        await thread_index.upsert(after)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        starter_cache.invalidate(payload.thread_id)
+        await thread_index.remove(payload.thread_id)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        # 论坛新帖的首楼：消息 ID 与帖子 ID 相同
+        if message.id == message.channel.id and self._is_forum_thread(message.channel):
+            starter_cache.put(message.id, message)
+            await thread_index.upsert(message.channel, message.content)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if payload.message_id != payload.channel_id: return
+        starter_cache.invalidate(payload.message_id)
+        if 'content' in payload.data: await thread_index.set_content(payload.message_id, payload.data['content'])
 
     async def get_todays_threads(self, guild):
         today_start = datetime.now(TZ_SHANGHAI).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-        threads_list = []
-        for forum in guild.forums:
-            perms = forum.permissions_for(guild.me)
-            if not perms.read_messages: continue
-            for thread in forum.threads:
-                if thread.created_at.timestamp() >= today_start:
-                    threads_list.append(thread)
-        threads_list.sort(key=lambda t: t.created_at.timestamp(), reverse=True)
-        return threads_list
+        forum_ids = [forum.id for forum in guild.forums if forum.permissions_for(guild.me).read_messages]
+        # 从帖子库里取（包括今天发了又被归档的），新的在前
+        return await thread_index.load(guild, await thread_index.created_since(forum_ids, today_start))
 
     async def refresh_channel_daily_panel(self, channel, resend=False):
         threads = await self.get_todays_threads(channel.guild)
@@ -346,9 +428,8 @@ class ExplorationCog(commands.Cog):
 
         if resend and target_msg:
             try: 
-                await target_msg.delete()
+                await scheduler.submit(("delete", channel.id), target_msg.delete)
                 target_msg = None 
-                await asyncio.sleep(0.5)
             except: pass
 
         if target_msg:
@@ -359,10 +440,10 @@ class ExplorationCog(commands.Cog):
 
     @tasks.loop(minutes=10)
     async def daily_task(self):
-        for channel_id in TARGET_CHANNEL_IDS:
-            channel = self.bot.get_channel(channel_id)
-            if channel: 
-                await self.refresh_channel_daily_panel(channel, resend=False)
+        channels = [self.bot.get_channel(channel_id) for channel_id in TARGET_CHANNEL_IDS]
+        results = await asyncio.gather(*[self.refresh_channel_daily_panel(channel, resend=False) for channel in channels if channel], return_exceptions=True)
+        for e in results:
+            if isinstance(e, Exception): print(f"Daily panel refresh failed: {e}")
 
     @daily_task.before_loop
     async def before_daily_task(self):
@@ -394,12 +475,13 @@ class ExplorationCog(commands.Cog):
         
         deleted_count = 0
         try:
+            old_panels = []
             async for msg in channel.history(limit=50):
                 if msg.author == self.bot.user and msg.embeds:
                     if msg.embeds[0].title == "🔍 奇米蛋搜索雷达":
-                        await msg.delete()
-                        deleted_count += 1
-                        await asyncio.sleep(0.5)
+                        old_panels.append(msg)
+            job = await scheduler.run_all("清理搜索面板", [(("delete", channel.id), msg.delete) for msg in old_panels])
+            deleted_count = job.done
         except Exception as e:
             print(f"Cleanup failed: {e}")
 
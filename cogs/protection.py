@@ -1,17 +1,25 @@
 import discord
 from discord import app_commands, ui
-from discord.ext import commands
+from discord.ext import commands, tasks
 import json
 import asyncio
-import io
+import time
 import re
 import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from urllib.parse import quote
-import aiosqlite
+import aiohttp
 
-from database import get_db
+from database import get_db, write_queue, download_log_writer, file_rows, FILE_ROWS_SQL
+from file_cache import attachment_cache, hash_file
+from spooling import CHUNK_SIZE, open_spool, close_files
+from cdn import attachment_url_cache, url_is_fresh, refresh_attachment_urls
+from likes_index import likes_index
+from bundles import bundle_builder, bundle_key, bundle_filename
+from storage import StorageBackend, storage_router, local_storage
+from scheduler import scheduler
+from starter_cache import starter_cache
 
 TZ_SHANGHAI = ZoneInfo("Asia/Shanghai")
 DAILY_DOWNLOAD_LIMIT = 50
@@ -20,6 +28,42 @@ TEST_ROLE_ID = 1402290127627091979
 # 【重要配置】备份频道ID
 BACKUP_CHANNEL_ID = 1452683440699867360
 
+# 附件下载：全局/单次请求并发上限、单文件超时（秒）、重试次数与退避基数（秒）
+DOWNLOAD_GLOBAL_CONCURRENCY = 16
+DOWNLOAD_PER_REQUEST_CONCURRENCY = 4
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+
+_download_semaphore = asyncio.Semaphore(DOWNLOAD_GLOBAL_CONCURRENCY)
+
+# 发布：单条备份消息的附件数与总字节数上限（超限的单个文件独占一条）、控制台进度刷新的最短间隔（秒）
+BACKUP_MESSAGE_MAX_FILES = 10
+BACKUP_MESSAGE_MAX_BYTES = 10 * 1024 * 1024
+PUBLISH_PROGRESS_INTERVAL = 2
+
+# 后台链接刷新：每隔多少分钟跑一次、提前多少秒刷新即将过期的链接、按下载量取多少个热门帖、最近几天发布的帖子也算热门
+URL_REFRESH_INTERVAL_MINUTES = 60
+URL_REFRESH_AHEAD = 6 * 3600
+URL_REFRESH_HOT_POSTS = 200
+URL_REFRESH_RECENT_DAYS = 3
+
+# 本地镜像：每隔多少小时把还没有本地副本的文件从 Discord 复制过来、每次最多复制多少个、同时复制几个
+MIRROR_INTERVAL_HOURS = 1
+MIRROR_BATCH_SIZE = 200
+MIRROR_CONCURRENCY = 4
+
+# 点赞回填：每个事务写入的条数、定时回填间隔（小时）；每页（100 人）的请求交给出站调度器限速
+BACKFILL_BATCH_SIZE = 1000
+BACKFILL_INTERVAL_HOURS = 6
+# 评论回填：每批处理的消息数、同时回填的子区数
+COMMENT_BACKFILL_BATCH_SIZE = 200
+COMMENT_BACKFILL_CONCURRENCY = 3
+
+# 管理面板的存活检查：确认存活后多少小时内不再向 Discord 核实、核实时的并发数
+POST_ALIVE_TTL_HOURS = 24
+POST_CHECK_CONCURRENCY = 5
+
 # --- Database Init ---
 async def init_likes_db():
     async with get_db() as db:
@@ -44,8 +88,123 @@ async def init_likes_db():
                 PRIMARY KEY (user_id, message_id)
             )
         """)
+        # 点赞回填进度：每条首楼消息的每种表情，没扫完的一轮停在哪个用户 ID；扫完后清空游标并记下当时的点赞数
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS likes_backfill_state (
+                message_id INTEGER, emoji TEXT, last_user_id INTEGER, updated_at TEXT,
+                PRIMARY KEY (message_id, emoji)
+            )
+        """)
+        # 评论回填进度：每个子区已经读到的最新消息 ID
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS comment_backfill_state (
+                thread_id INTEGER PRIMARY KEY, last_message_id INTEGER, updated_at TEXT
+            )
+        """)
+        try: await db.execute("ALTER TABLE likes_backfill_state ADD COLUMN reaction_count INTEGER")
+        except Exception: pass
         await db.commit()
 
+# --- Protected Message Registry ---
+class ProtectedRegistry:
+    """
+    保护贴消息 ID 及其所在频道/子区 ID 的内存登记表，发布和删除时同步更新。
+    只有这些 ID 上的点赞会被 check_requirements_common 读到（子区首楼的消息 ID 就是子区 ID），
+    也只有这些子区里的评论有意义；其余事件在监听器里直接丢弃，不进数据库。
+    启动加载完成前不做过滤，避免漏记；登记之前就有的点赞和评论（例如把旧消息转为保护附件）由 backfill_new_post 补录。
+    """
+    def __init__(self):
+        self.messages = {}        # 保护贴 message_id -> channel_id
+        self.channel_counts = {}  # channel_id -> 该频道/子区内的保护贴数量
+        self.ready = False
+
+    async def load(self):
+        async with get_db() as db:
+            rows = await (await db.execute("SELECT message_id, channel_id FROM protected_items")).fetchall()
+        for row in rows: self.add(row['message_id'], row['channel_id'])
+        self.ready = True
+
+    def add(self, message_id, channel_id):
+        if message_id in self.messages: return
+        self.messages[message_id] = channel_id
+        self.channel_counts[channel_id] = self.channel_counts.get(channel_id, 0) + 1
+
+    def remove(self, message_id):
+        channel_id = self.messages.pop(message_id, None)
+        if channel_id is None: return
+        self.channel_counts[channel_id] -= 1
+        if self.channel_counts[channel_id] <= 0: del self.channel_counts[channel_id]
+
+    def is_like_target(self, message_id) -> bool:
+        return not self.ready or message_id in self.messages or message_id in self.channel_counts
+
+    def is_comment_target(self, channel_id) -> bool:
+        return not self.ready or channel_id in self.channel_counts
+
+protected_registry = ProtectedRegistry()
+
+async def forget_protected_posts(message_ids):
+    """保护贴消息已被删除：删掉数据库记录，并同步登记表和点赞索引"""
+    message_ids = [mid for mid in message_ids if not protected_registry.ready or mid in protected_registry.messages]
+    if not message_ids: return
+    async with get_db() as db:
+        await db.executemany("DELETE FROM protected_items WHERE message_id = ?", [(mid,) for mid in message_ids])
+        await db.executemany("DELETE FROM protected_files WHERE message_id = ?", [(mid,) for mid in message_ids])
+        await db.commit()
+    for mid in message_ids:
+        protected_registry.remove(mid)
+        likes_index.discard(mid)
+
+# --- Protected Files ---
+
+def _file_item(row):
+    """protected_files 的一行 -> 与旧 storage_urls 条目相同结构的 dict"""
+    return {
+        "strategy": row['strategy'], "channel_id": row['backup_channel_id'], "message_id": row['backup_message_id'],
+        "attachment_index": row['attachment_index'], "filename": row['filename'], "url": row['url'],
+        "content_hash": row['content_hash'],
+    }
+
+async def load_post_files(message_id):
+    """按顺序读出一个保护贴的文件列表"""
+    async with get_db() as db:
+        rows = await (await db.execute("SELECT * FROM protected_files WHERE message_id = ? ORDER BY file_index", (message_id,))).fetchall()
+    return [_file_item(row) for row in rows]
+
+async def rename_post_file(message_id, file_index, filename):
+    async with get_db() as db:
+        await db.execute("UPDATE protected_files SET filename = ? WHERE message_id = ? AND file_index = ?", (filename, message_id, file_index))
+        await db.commit()
+
+# --- Daily Download Quota ---
+class DownloadQuotaLedger:
+    """
+    每日下载次数的内存缓存，按上海日期自动换日。
+    持久化副本是 download_quota 表，由 download_log_writer 和 download_log 在同一事务内递增。
+    """
+    def __init__(self):
+        self.day = None
+        self.counts = {}
+
+    def _roll_day(self):
+        today = datetime.now(TZ_SHANGHAI).strftime("%Y-%m-%d")
+        if today != self.day: self.day, self.counts = today, {}
+        return today
+
+    async def get(self, user_id) -> int:
+        day = self._roll_day()
+        if user_id not in self.counts:
+            async with get_db() as db:
+                row = await (await db.execute("SELECT count FROM download_quota WHERE user_id = ? AND day = ?", (user_id, day))).fetchone()
+            if day == self.day: self.counts.setdefault(user_id, row[0] if row else 0)
+            else: return row[0] if row else 0
+        return self.counts[user_id]
+
+    def incr(self, user_id, day):
+        if day == self.day and user_id in self.counts: self.counts[user_id] += 1
+
+quota_ledger = DownloadQuotaLedger()
+
 # --- Helper: Comment Validator ---
 def is_valid_comment(content: str) -> bool:
     if not content: return False
@@ -60,66 +219,379 @@ def is_valid_comment(content: str) -> bool:
 
 # --- Shared Logic Helpers ---
 
-async def fetch_files_common(bot, file_data):
-    results = []
-    if not isinstance(file_data, list): return []
-    fetched_messages = {} 
+async def _resolve_backup_attachments(bot, cid, mid):
+    """读取备份消息的附件列表 [(url, size), ...]，失败返回 None"""
+    try:
+        channel = bot.get_channel(cid)
+        if not channel: 
+            try: channel = await bot.fetch_channel(cid)
+            except: pass 
+        if channel:
+            msg = await channel.fetch_message(mid)
+            return [(att.url, att.size) for att in msg.attachments]
+    except Exception:
+        pass
+    return None
 
-    for item in file_data:
-        if not isinstance(item, dict): continue
-        download_url = item.get('url')
-        
-        if item.get('strategy') == 'msg_ref':
-            cid = item.get('channel_id')
-            mid = item.get('message_id')
+def _split_backup_batches(sizes, max_files=BACKUP_MESSAGE_MAX_FILES, max_bytes=BACKUP_MESSAGE_MAX_BYTES):
+    """按原顺序把文件分成若干条备份消息，返回 [[文件下标, ...], ...]"""
+    batches, current, current_bytes = [], [], 0
+    for idx, size in enumerate(sizes):
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(idx)
+        current_bytes += size
+    if current: batches.append(current)
+    return batches
+
+async def _download_with_retry(bot, url, size_hint=None):
+    """
+    单文件流式下载到临时文件缓冲区（见 spooling.open_spool），返回已回到开头的文件对象。
+    受全局并发限制，超时/5xx/429 按指数退避重试，其他 4xx 直接放弃。
+    """
+    timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
+    for attempt in range(DOWNLOAD_RETRIES):
+        spool = None
+        try:
+            async with _download_semaphore:
+                async with bot.http_session.get(url, timeout=timeout) as resp:
+                    if resp.status == 200:
+                        spool = open_spool(size_hint or resp.content_length)
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            spool.write(chunk)
+                        if spool.tell() == 0:
+                            spool.close()
+                            return None
+                        spool.seek(0)
+                        return spool
+                    if resp.status < 500 and resp.status != 429: return None
+                    print(f"DL Error: HTTP {resp.status} (第{attempt + 1}次)")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if spool: spool.close()
+            print(f"DL Error: {e!r} (第{attempt + 1}次)")
+        except BaseException:
+            if spool: spool.close()
+            raise
+        if attempt < DOWNLOAD_RETRIES - 1: await asyncio.sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+    return None
+
+class DiscordMessageBackend(StorageBackend):
+    """
+    Discord 消息引用后端：文件是备份消息（私信或备份频道）里的附件。
+    读取时优先用库里仍然新鲜的链接，否则解析备份消息拿新链接（走进程级缓存），下载失败会重新解析一次。
+    """
+    name = "discord"
+
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+
+    async def open(self, item):
+        download_url, size_hint, msg_key = item.get('url'), None, None
+        async def _resolve():
+            attachments = await attachment_url_cache.get(msg_key, lambda: _resolve_backup_attachments(self.bot, *msg_key))
             idx = item.get('attachment_index', 0)
-            
-            if cid and mid:
-                msg = fetched_messages.get((cid, mid))
-                if not msg:
-                    try:
-                        channel = bot.get_channel(cid)
-                        if not channel: 
-                            try: channel = await bot.fetch_channel(cid)
-                            except: pass 
-                        
-                        if channel:
-                            msg = await channel.fetch_message(mid)
-                            fetched_messages[(cid, mid)] = msg
-                    except Exception:
-                        pass
-                
-                if msg and 0 <= idx < len(msg.attachments):
-                    download_url = msg.attachments[idx].url
+            if attachments and 0 <= idx < len(attachments): return attachments[idx]
+            return None, None
+        if item.get('strategy') == 'msg_ref' and item.get('channel_id') and item.get('message_id'):
+            msg_key = (item['channel_id'], item['message_id'])
+            if not url_is_fresh(download_url): download_url, size_hint = await _resolve()
+        if not download_url: return None
 
-        if not download_url: continue
+        spool = await _download_with_retry(self.bot, download_url, size_hint)
+        if not spool and msg_key:
+            # 链接可能提前失效，丢掉缓存重新解析一次
+            attachment_url_cache.invalidate(msg_key)
+            retry_url, size_hint = await _resolve()
+            if retry_url and retry_url != download_url:
+                spool = await _download_with_retry(self.bot, retry_url, size_hint)
+        if not spool: raise IOError(f"下载失败: {item.get('filename')}")
+        return spool
 
-        try:
-            async with bot.http_session.get(download_url) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    if len(data) > 0:
-                        results.append({'filename': item.get('filename', 'unknown'), 'bytes': data})
-        except Exception as e: 
-            print(f"DL Error: {e}")
-            
-    return results
+async def fetch_files_common(bot, file_data, concurrency=DOWNLOAD_PER_REQUEST_CONCURRENCY):
+    if not isinstance(file_data, list): return []
+    items = [item for item in file_data if isinstance(item, dict)]
 
-def make_discord_files_common(file_results):
-    return [discord.File(io.BytesIO(res['bytes']), filename=res['filename']) for res in file_results]
+    request_semaphore = asyncio.Semaphore(concurrency)
+    async def _fetch_one(item):
+        filename = item.get('filename', 'unknown')
+        # 1. 本地存储有副本时直接读本地，不经过磁盘缓存（也就不算缓存未命中）
+        if item.get('content_hash'):
+            started = time.monotonic()
+            try: fp = await local_storage.open(item)
+            except OSError as e:
+                local_storage.record_failure()
+                print(f"Storage Error (local): {e}")
+                fp = None
+            if fp:
+                local_storage.record_success(time.monotonic() - started)
+                return {'filename': filename, 'fp': fp}
 
-async def record_download_common(user, item_row):
-    async def _update():
-        async with get_db() as db:
-            db.row_factory = aiosqlite.Row
-            message_id = item_row['message_id']
-            await db.execute("UPDATE protected_items SET download_count = download_count + 1 WHERE message_id = ?", (message_id,))
+        # 2. 再查磁盘缓存
+        cached_fp = await attachment_cache.open(attachment_cache.key_for(item))
+        if cached_fp: return {'filename': filename, 'fp': cached_fp}
+
+        # 3. 从最快的健康存储后端读取，单次请求内限制并发，结果按原顺序返回
+        async with request_semaphore:
+            fp, backend = await storage_router.open(item)
+        if not fp: return None
+        if backend is not local_storage:
+            # 第一次下载的旧附件先算出哈希记下来，再和其他文件一样按哈希存进本地存储，下次直接读本地
+            if not item.get('content_hash') and item.get('strategy') == 'msg_ref' and item.get('channel_id') and item.get('message_id'):
+                item['content_hash'] = await asyncio.to_thread(hash_file, fp)
+                _remember_content_hash(item, item['content_hash'], fp)
+            # 存不进本地存储（没有哈希或写入失败）时才放进磁盘缓存
+            if not (item.get('content_hash') and await local_storage.put(item, fp)):
+                await attachment_cache.put_file(attachment_cache.key_for(item), fp)
+        return {'filename': filename, 'fp': fp}
+
+    results = await asyncio.gather(*[_fetch_one(item) for item in items])
+    return [res for res in results if res]
+
+def _remember_content_hash(item, content_hash, fp):
+    """第一次下载旧附件时顺便记下内容哈希，之后同样内容的附件共用缓存，发布时也能复用"""
+    size = fp.seek(0, os.SEEK_END); fp.seek(0)
+    ref = (item['channel_id'], item['message_id'], item.get('attachment_index', 0))
+    write_queue.put(("content_hash",) + ref, "UPDATE protected_files SET content_hash = ? WHERE backup_channel_id = ? AND backup_message_id = ? AND attachment_index = ?", (content_hash,) + ref)
+    write_queue.put(("content_index", content_hash), "INSERT OR IGNORE INTO content_index (content_hash, size, backup_channel_id, backup_message_id, attachment_index, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (content_hash, size) + ref + (datetime.now(TZ_SHANGHAI).isoformat(),))
+
+async def _find_existing_content(bot, content_hash, size):
+    """content_index 里有同样内容、且那条备份附件仍然能读到时，返回可以直接引用的 msg_ref 字段，否则返回 None"""
+    async with get_db() as db:
+        row = await (await db.execute("SELECT * FROM content_index WHERE content_hash = ?", (content_hash,))).fetchone()
+    if not row or row['size'] != size: return None
+    msg_key = (row['backup_channel_id'], row['backup_message_id'])
+    attachments = await attachment_url_cache.get(msg_key, lambda: _resolve_backup_attachments(bot, *msg_key))
+    idx = row['attachment_index']
+    if not attachments or not 0 <= idx < len(attachments) or attachments[idx][1] != size: return None
+    return {"strategy": "msg_ref", "channel_id": msg_key[0], "message_id": msg_key[1], "attachment_index": idx, "url": attachments[idx][0]}
+
+async def open_post_bundle(bot, file_data):
+    """打包模式：返回整包 zip 的文件句柄（调用方负责关闭），失败返回 None。缺文件时不打包，避免缓存残缺的包"""
+    async def _fetch():
+        results = await fetch_files_common(bot, file_data)
+        if len(results) == len(file_data): return results
+        close_files(results)
+        return []
+    return await bundle_builder.open(bundle_key(file_data), _fetch)
+
+async def _prebuild_bundle(bot, file_data):
+    fp = await open_post_bundle(bot, file_data)
+    if fp: fp.close()
+
+async def mirror_to_local(limit=MIRROR_BATCH_SIZE):
+    """把还没有本地副本的保护贴文件从 Discord 复制到本地存储（同一内容只复制一次），返回 (成功数, 失败数)"""
+    discord_backend = storage_router.get("discord")
+    if not discord_backend: return 0, 0
+    async with get_db() as db:
+        rows = await (await db.execute(
+            "SELECT * FROM protected_files GROUP BY COALESCE(content_hash, backup_channel_id || '_' || backup_message_id || '_' || attachment_index) ORDER BY message_id DESC"
+        )).fetchall()
+    items = [_file_item(row) for row in rows]
+    missing = await asyncio.to_thread(lambda: [item for item in items if not local_storage.has(item['content_hash'])])
+    semaphore = asyncio.Semaphore(MIRROR_CONCURRENCY)
+    async def _copy(item):
+        async with semaphore:
+            try: fp = await discord_backend.open(item)
+            except Exception: return False
+            if not fp: return False
             try:
-                file_data = json.loads(item_row['storage_urls'])
-                filenames = json.dumps([f.get('filename','unknown') for f in file_data if isinstance(f, dict)])
-            except: filenames = "[]"
-            await db.execute("INSERT INTO download_log (user_id, message_id, title, filenames, timestamp) VALUES (?, ?, ?, ?, ?)", (user.id, message_id, item_row['title'], filenames, datetime.now(TZ_SHANGHAI).isoformat())); await db.commit()
-    asyncio.create_task(_update())
+                if not item['content_hash']:
+                    item['content_hash'] = await asyncio.to_thread(hash_file, fp)
+                    if item['strategy'] == 'msg_ref' and item['channel_id'] and item['message_id']: _remember_content_hash(item, item['content_hash'], fp)
+                return await local_storage.put(item, fp)
+            finally: fp.close()
+    results = await asyncio.gather(*[_copy(item) for item in missing[:limit]])
+    return sum(results), len(results) - sum(results)
+
+async def collect_local_garbage():
+    """清理本地存储里已经没有任何保护贴文件引用的副本（保护贴被删除后留下的），返回 (文件数, 字节数)"""
+    async with get_db() as db:
+        rows = await (await db.execute("SELECT DISTINCT content_hash FROM protected_files WHERE content_hash IS NOT NULL")).fetchall()
+    return await local_storage.collect_garbage(row[0] for row in rows)
+
+def make_discord_files_common(file_results):
+    """用 fetch 出来的文件句柄构造 discord.File；发送后需调用 close_files(file_results) 释放"""
+    files = []
+    for res in file_results:
+        res['fp'].seek(0)
+        files.append(discord.File(res['fp'], filename=res['filename']))
+    return files
+
+async def record_download_common(user, item_row, file_data=None):
+    now = datetime.now(TZ_SHANGHAI)
+    day = now.strftime("%Y-%m-%d")
+    # 先确保缓存已载入再在内存里 +1，这样调用方紧接着读到的剩余额度就是准确的
+    await quota_ledger.get(user.id)
+    quota_ledger.incr(user.id, day)
+    if file_data is None: file_data = await load_post_files(item_row['message_id'])
+    filenames = json.dumps([f.get('filename','unknown') for f in file_data])
+    # 交给后台写入器批量落库；队列满时在这里等待
+    await download_log_writer.put(user.id, item_row['message_id'], item_row['title'], filenames, now.isoformat(), day)
+
+async def refresh_stored_urls(bot, message_ids):
+    """
+    批量刷新指定保护贴里即将过期（URL_REFRESH_AHEAD 秒内）的附件链接，并写回 protected_files。
+    返回刷新成功的链接数。
+    """
+    if not message_ids: return 0
+    rows = []
+    async with get_db() as db:
+        for i in range(0, len(message_ids), 500):
+            chunk = tuple(message_ids[i:i + 500])
+            sql = f"SELECT url FROM protected_files WHERE url IS NOT NULL AND message_id IN ({','.join('?' * len(chunk))})"
+            rows += await (await db.execute(sql, chunk)).fetchall()
+
+    stale_urls = [row['url'] for row in rows if not url_is_fresh(row['url'], URL_REFRESH_AHEAD)]
+    if not stale_urls: return 0
+
+    refreshed = await refresh_attachment_urls(bot.http, stale_urls)
+    if not refreshed: return 0
+    # 只改 url 这一列，不会覆盖刷新期间的改名
+    async with get_db() as db:
+        await db.executemany("UPDATE protected_files SET url = ? WHERE url = ?", [(new, old) for old, new in refreshed.items()])
+        await db.commit()
+    return len(refreshed)
+
+# --- Likes Backfill ---
+
+async def _fetch_like_target(bot, message_id, channel_id):
+    """保护贴对应的点赞目标：在子区里是子区首楼（消息 ID 与子区 ID 相同），否则是面板消息本身"""
+    channel = bot.get_channel(channel_id)
+    if not channel:
+        try: channel = await bot.fetch_channel(channel_id)
+        except: return None
+    target_id = channel.id if isinstance(channel, discord.Thread) else message_id
+    try: return await channel.fetch_message(target_id)
+    except: return None
+
+async def _save_backfill_batch(message_id, emoji, user_ids, last_user_id, reaction_count=None):
+    """
+    一批点赞和回填进度在同一个事务里提交。last_user_id 是这一轮扫到的位置，中途中断时下次从这里接着扫；
+    一轮扫完时传 None 并记下 reaction_count。
+    """
+    async with get_db() as db:
+        await db.executemany("INSERT OR IGNORE INTO cached_likes (message_id, user_id) VALUES (?, ?)", [(message_id, uid) for uid in user_ids])
+        await db.execute(
+            "INSERT OR REPLACE INTO likes_backfill_state (message_id, emoji, last_user_id, reaction_count, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (message_id, emoji, last_user_id, reaction_count, datetime.now(TZ_SHANGHAI).isoformat())
+        )
+        await db.commit()
+    likes_index.add_many(message_id, user_ids)
+
+async def backfill_cached_likes(bot, full=False, progress=None, targets=None):
+    """
+    把所有保护贴（或 targets 给出的 [(message_id, channel_id)]）首楼上已有的点赞分页拉下来写进 cached_likes。
+    接口按用户 ID 升序分页，而不是按点赞时间，所以保存的用户 ID 只用来续上被中断的一轮；
+    一轮扫完后记下当时的点赞数，之后点赞数没变的表情跳过，变了就从头重扫；full=True 时全部从头重扫。
+    progress(已写入数, 已用秒数) 会在每批写入后调用。返回 (写入的点赞数, 耗时秒数)。
+    """
+    async with get_db() as db:
+        rows = targets or await (await db.execute("SELECT message_id, channel_id FROM protected_items")).fetchall()
+        state_rows = [] if full else await (await db.execute("SELECT message_id, emoji, last_user_id, reaction_count FROM likes_backfill_state")).fetchall()
+    checkpoints = {(r['message_id'], r['emoji']): (r['last_user_id'], r['reaction_count']) for r in state_rows}
+
+    total, started, done_targets = 0, time.monotonic(), set()
+    for message_id, channel_id in rows:
+        msg = await _fetch_like_target(bot, message_id, channel_id)
+        if not msg or msg.id in done_targets: continue
+        done_targets.add(msg.id)
+        for reaction in msg.reactions:
+            emoji = reaction.emoji if isinstance(reaction.emoji, str) else f"{reaction.emoji.name}:{reaction.emoji.id}"
+            after, scanned_count = checkpoints.get((msg.id, emoji), (None, None))
+            if after is None and scanned_count == reaction.count: continue
+            batch = []
+            while True:
+                # 直接按页请求：接口按用户 ID 升序返回，每页最后一个 ID 就是下一页的起点；
+                # 请求走出站调度器，同一频道的翻页串行，遇到 429 按 Retry-After 冷却后重试
+                page = await scheduler.submit(("reactions", msg.channel.id),
+                                              lambda after=after: bot.http.get_reaction_users(msg.channel.id, msg.id, emoji, 100, after=after))
+                if not page: break
+                batch.extend(int(u['id']) for u in page if int(u['id']) != bot.user.id)
+                after = int(page[-1]['id'])
+                if len(page) < 100: break
+                if len(batch) >= BACKFILL_BATCH_SIZE:
+                    await _save_backfill_batch(msg.id, emoji, batch, after)
+                    total += len(batch)
+                    batch = []
+                    if progress: await progress(total, time.monotonic() - started)
+            # 这一轮扫完：清掉游标，记下点赞数
+            await _save_backfill_batch(msg.id, emoji, batch, None, reaction.count)
+            total += len(batch)
+            if batch and progress: await progress(total, time.monotonic() - started)
+    return total, time.monotonic() - started
+
+# --- Comments Backfill ---
+
+async def _save_comment_batch(thread_id, rows, last_message_id):
+    """一批评论和子区进度在同一个事务里提交；已有记录不覆盖（监听器写入的更新）。返回新增的评论数"""
+    async with get_db() as db:
+        before = db.total_changes
+        if rows: await db.executemany("INSERT OR IGNORE INTO user_comments (user_id, message_id, content) VALUES (?, ?, ?)", rows)
+        inserted = db.total_changes - before
+        await db.execute(
+            "INSERT OR REPLACE INTO comment_backfill_state (thread_id, last_message_id, updated_at) VALUES (?, ?, ?)",
+            (thread_id, last_message_id, datetime.now(TZ_SHANGHAI).isoformat())
+        )
+        await db.commit()
+    return inserted
+
+async def _backfill_thread_comments(thread, after_id):
+    """从进度处往后读子区历史，按批校验并写入有效评论，返回写入的评论数"""
+    found, batch, scanned, last_id = 0, {}, 0, None
+    after = discord.Object(id=after_id) if after_id else None
+    async for msg in thread.history(limit=None, after=after, oldest_first=True):
+        scanned += 1
+        last_id = msg.id
+        if not msg.author.bot and is_valid_comment(msg.content):
+            batch.setdefault(msg.author.id, (msg.author.id, thread.id, msg.content[:50]))
+        if scanned >= COMMENT_BACKFILL_BATCH_SIZE:
+            found += await _save_comment_batch(thread.id, list(batch.values()), last_id)
+            batch, scanned = {}, 0
+    if last_id and scanned:
+        found += await _save_comment_batch(thread.id, list(batch.values()), last_id)
+    return found
+
+async def backfill_comments(bot, full=False, channel_ids=None):
+    """
+    回填所有含保护贴的子区（或 channel_ids 给出的子区）里已有的评论到 user_comments。
+    每个子区记录读到的最新消息 ID，下次只读之后的新消息；多个子区按 COMMENT_BACKFILL_CONCURRENCY 并发。
+    返回 (写入的评论数, 处理的子区数, 耗时秒数)。
+    """
+    async with get_db() as db:
+        if channel_ids is None: channel_ids = [r['channel_id'] for r in await (await db.execute("SELECT DISTINCT channel_id FROM protected_items")).fetchall()]
+        state_rows = [] if full else await (await db.execute("SELECT thread_id, last_message_id FROM comment_backfill_state")).fetchall()
+    checkpoints = {r['thread_id']: r['last_message_id'] for r in state_rows}
+
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(COMMENT_BACKFILL_CONCURRENCY)
+    async def _one(channel_id):
+        async with semaphore:
+            channel = bot.get_channel(channel_id)
+            if not channel:
+                try: channel = await bot.fetch_channel(channel_id)
+                except: return None
+            if not isinstance(channel, discord.Thread): return None
+            try: return await _backfill_thread_comments(channel, checkpoints.get(channel_id))
+            except Exception as e:
+                print(f"Comment backfill error in {channel_id}: {e}")
+                return None
+    results = await asyncio.gather(*[_one(channel_id) for channel_id in channel_ids])
+    done = [r for r in results if r is not None]
+    return sum(done), len(done), time.monotonic() - started
+
+async def backfill_new_post(bot, message_id, channel_id):
+    """
+    新保护贴登记后立刻补录它首楼上已有的点赞和所在子区里已有的评论：
+    登记之前监听器不记录这些事件，转为保护附件的旧消息上的点赞和评论要靠这里补上，不必等定时回填。
+    """
+    try:
+        likes, _ = await backfill_cached_likes(bot, targets=[(message_id, channel_id)])
+        comments, _, _ = await backfill_comments(bot, channel_ids=[channel_id])
+        if likes or comments: print(f"新保护贴 {message_id} 补录：{likes} 个点赞，{comments} 条评论")
+    except Exception as e: print(f"New post backfill error ({message_id}): {e}")
 
 async def check_requirements_common(interaction, unlock_type, owner_id, panel_message_id):
     user = interaction.user
@@ -131,10 +603,7 @@ async def check_requirements_common(interaction, unlock_type, owner_id, panel_me
     if is_owner: return True, "owner"
 
     # 2. 频率限制
-    today_start = datetime.now(TZ_SHANGHAI).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-    async with get_db() as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM download_log WHERE user_id = ? AND timestamp >= ?", (user.id, today_start))
-        cnt = (await cursor.fetchone())[0]
+    cnt = await quota_ledger.get(user.id)
     if cnt >= DAILY_DOWNLOAD_LIMIT:
         return False, f"⚠️ 您今日的下载次数已达上限（{DAILY_DOWNLOAD_LIMIT}/{DAILY_DOWNLOAD_LIMIT}）。"
 
@@ -143,21 +612,14 @@ async def check_requirements_common(interaction, unlock_type, owner_id, panel_me
     if isinstance(interaction.channel, discord.Thread):
         target_check_id = interaction.channel.id 
 
-    has_liked = False
-    async with get_db() as db:
-        cursor = await db.execute("SELECT 1 FROM user_likes WHERE user_id = ? AND message_id = ?", (user.id, target_check_id))
-        if await cursor.fetchone(): has_liked = True
-        
-        if not has_liked:
-            cursor = await db.execute("SELECT 1 FROM cached_likes WHERE user_id = ? AND message_id = ?", (user.id, target_check_id))
-            if await cursor.fetchone(): has_liked = True
+    has_liked = await likes_index.has_liked(target_check_id, user.id, interaction.guild_id)
 
     if not has_liked:
         jump_url = f"https://discord.com/channels/{interaction.guild_id}/{interaction.channel_id}/{target_check_id}"
         return False, (
             f"🛑 **数据库未找到点赞记录！**\n"
             f"请跳转到 **[帖子首楼]({jump_url})** 点个赞 👍。\n"
-            f"⚠️ **重要提示**：Bot不实时监听旧消息，如果没反应，**请取消点赞，然后重新点一次**，即可秒级记录。"
+            f"⚠️ **提示**：如果点过赞但没被记录，**请取消点赞，然后重新点一次**，即可秒级记录（Bot 离线期间的点赞也会每 {BACKFILL_INTERVAL_HOURS} 小时自动补录）。"
         )
 
     # 4. 评论检测
@@ -165,6 +627,7 @@ async def check_requirements_common(interaction, unlock_type, owner_id, panel_me
         has_commented = False
         current_thread_id = interaction.channel.id
         
+        await write_queue.flush() # 刚发的评论可能还在批量队列里
         async with get_db() as db:
             cursor = await db.execute("SELECT 1 FROM user_comments WHERE user_id = ? AND message_id = ?", (user.id, current_thread_id))
             if await cursor.fetchone(): has_commented = True
@@ -173,7 +636,7 @@ async def check_requirements_common(interaction, unlock_type, owner_id, panel_me
             return False, (
                 "💬 **数据库未找到评论记录！**\n"
                 "请在当前帖子内发送一条有意义的评论（>5字，禁纯水）。\n"
-                "⚠️ **注意**：Bot 不会读取历史消息。如果您之前评论过但没被记录，请**重新发一条**。"
+                f"⚠️ **提示**：如果评论过但没被记录，请**重新发一条**，即可秒级记录（Bot 离线期间的评论也会每 {BACKFILL_INTERVAL_HOURS} 小时自动补录）。"
             )
 
     return True, "passed"
@@ -198,19 +661,24 @@ class AuthorNoteView(ui.View):
         await interaction.response.edit_message(view=self)
         
         # Download logic
+        file_results = []
         try:
-            file_data = json.loads(self.row['storage_urls'])
-            file_results = await fetch_files_common(self.bot, file_data)
+            file_data = await load_post_files(self.row['message_id'])
+            if self.row['bundle']:
+                # 打包模式：发一个预先打好的 zip；太大发不出去时退回逐个发送
+                bundle_fp = await open_post_bundle(self.bot, file_data)
+                limit = interaction.guild.filesize_limit if interaction.guild else BACKUP_MESSAGE_MAX_BYTES
+                if bundle_fp and os.fstat(bundle_fp.fileno()).st_size <= limit:
+                    file_results = [{'filename': bundle_filename(self.row['title']), 'fp': bundle_fp}]
+                elif bundle_fp: bundle_fp.close()
+            if not file_results: file_results = await fetch_files_common(self.bot, file_data)
             
             # Record log
-            await record_download_common(interaction.user, self.row)
+            await record_download_common(interaction.user, self.row, file_data)
             
             if file_results:
                 # Calculate limit
-                today_start_iso = datetime.now(TZ_SHANGHAI).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-                async with get_db() as db:
-                    cursor = await db.execute("SELECT COUNT(*) FROM download_log WHERE user_id = ? AND timestamp >= ?", (interaction.user.id, today_start_iso))
-                    cnt = (await cursor.fetchone())[0]
+                cnt = await quota_ledger.get(interaction.user.id)
                 
                 # Send Files (Clean message, no Log)
                 await interaction.followup.send(
@@ -222,6 +690,8 @@ class AuthorNoteView(ui.View):
                 await interaction.followup.send("❌ 文件数据读取失败，请联系管理员。", ephemeral=True)
         except Exception as e:
             await interaction.followup.send(f"❌ 发生未知错误: {e}", ephemeral=True)
+        finally:
+            close_files(file_results)
 
 async def start_download_flow(interaction: discord.Interaction, bot, row):
     """
@@ -348,6 +818,7 @@ class ProtectionDraftView(ui.View):
         self.draft_log = default_log
         self.draft_password = None
         self.draft_mode = "like"
+        self.draft_bundle = False
         self.custom_names = {} 
     
     async def update_dashboard(self, interaction: discord.Interaction):
@@ -358,7 +829,8 @@ class ProtectionDraftView(ui.View):
 
         status_desc = (f"📦 **已传文件**: {file_status}\n🏷️ **当前标题**: {self.draft_title}\n📝 **作者提示**: {'✅ ' + log_preview if self.draft_log else '⚪ 未设置'}\n")
         mode_map = {"like": "👍 点赞解锁", "like_comment": "💬 点赞+评论", "like_password": f"🔐 点赞+口令 (口令: ||{self.draft_password}||)", "like_comment_password": f"🔐💬 点赞+评论+口令 (口令: ||{self.draft_password}||)"}
-        status_desc += f"⚙️ **获取方式**: {mode_map.get(self.draft_mode)}"
+        status_desc += f"⚙️ **获取方式**: {mode_map.get(self.draft_mode)}\n"
+        status_desc += f"🗜️ **打包下载**: {'✅ 开启（下载时发送一个 zip）' if self.draft_bundle else '⚪ 关闭'}"
         guide_desc = ("1️⃣ 点击 **第一排** 修改标题、说明或 **修改文件名**。\n2️⃣ 点击 **第二排** 选择解锁条件。\n3️⃣ 确认无误后，点击底部的 **🚀 确认发布**。")
         embed = discord.Embed(title="🛠️ 附件保护控制台", color=0x87ceeb); embed.add_field(name="📊 当前配置状态", value=status_desc, inline=False); embed.add_field(name="📖 操作指引", value=guide_desc, inline=False); embed.set_footer(text="此面板仅你自己可见")
         
@@ -390,6 +862,9 @@ class ProtectionDraftView(ui.View):
     @ui.button(label="点赞+评论+口令", style=discord.ButtonStyle.success, row=1, emoji="🔐")
     async def mode_like_comm_pass(self, i: discord.Interaction, b: ui.Button): await i.response.send_modal(DraftPasswordModal(self, "like_comment_password"))
     
+    @ui.button(label="打包下载", style=discord.ButtonStyle.secondary, row=2, emoji="🗜️")
+    async def btn_toggle_bundle(self, i: discord.Interaction, b: ui.Button): self.draft_bundle = not self.draft_bundle; await self.update_dashboard(i)
+
     @ui.button(label="确认发布", style=discord.ButtonStyle.danger, row=2, emoji="🚀")
     async def btn_confirm(self, i: discord.Interaction, b: ui.Button): 
         await i.response.edit_message(content="⏳ 正在加密上传...", embed=None, view=None)
@@ -400,34 +875,93 @@ class ProtectionDraftView(ui.View):
         await i.response.edit_message(content="操作已取消。", embed=None, view=None); self.stop()
 
     async def publish(self, interaction: discord.Interaction):
-        files_to_send, file_metadata = [], []
-        try:
-            for idx, att in enumerate(self.attachments): 
-                file_bytes = await att.read()
-                final_filename = self.custom_names.get(idx, att.filename)
-                f = discord.File(io.BytesIO(file_bytes), filename=final_filename)
-                files_to_send.append(f)
-        except Exception as e: return await interaction.followup.send(f"文件读取失败：{e}", ephemeral=True)
-        
-        stored_data = []
-        try:
-            # 优先私信，失败转存备份频道
-            try:
-                dm = await self.user.create_dm()
-                backup_msg = await dm.send(content=f"【{self.draft_title}】的私信备份！\nID: {interaction.id}\n(此消息仅作为文件源，请勿删除)", files=files_to_send)
-            except:
+        """
+        发布流水线：附件并发流式读入临时文件缓冲区，按大小分成若干条备份消息，
+        某一组读完就立刻上传，不等其他组；控制台上分阶段显示进度。
+        读完的文件先算 sha256，内容索引里已有可用备份的直接引用，不再重复上传。
+        """
+        total = len(self.attachments)
+        batches = _split_backup_batches([att.size for att in self.attachments])
+        progress = {"read": 0, "sent": 0, "reused": 0}
+        last_edit = 0
+        async def report(stage="⏳ 正在加密上传...", force=False):
+            nonlocal last_edit
+            if not force and time.monotonic() - last_edit < PUBLISH_PROGRESS_INTERVAL: return
+            last_edit = time.monotonic()
+            text = f"{stage}\n📥 读取附件：{progress['read']}/{total}\n📤 上传备份：{progress['sent']}/{len(batches)}"
+            if progress['reused']: text += f"\n♻️ 复用已有备份：{progress['reused']} 个"
+            try: await interaction.edit_original_response(content=text)
+            except: pass
+        await report(force=True)
+
+        # 1. 读取：并发读入，大文件不会整个驻留内存
+        spooled_files = [None] * total
+        read_semaphore = asyncio.Semaphore(DOWNLOAD_PER_REQUEST_CONCURRENCY)
+        async def _read(idx):
+            att = self.attachments[idx]
+            async with read_semaphore:
+                spool = await _download_with_retry(self.bot, att.url, att.size)
+            if spool is None: raise IOError(f"无法读取 {att.filename}")
+            spooled_files[idx] = {'filename': self.custom_names.get(idx, att.filename), 'fp': spool}
+            content_hash = await asyncio.to_thread(hash_file, spool)
+            spooled_files[idx]['content_hash'] = content_hash
+            spooled_files[idx]['existing'] = await _find_existing_content(self.bot, content_hash, att.size)
+            if spooled_files[idx]['existing']:
+                progress['reused'] += 1
+                close_files([spooled_files[idx]])  # 不用上传，提前释放缓冲区
+            progress['read'] += 1
+            await report()
+            return spooled_files[idx]
+        read_tasks = [asyncio.create_task(_read(idx)) for idx in range(total)]
+
+        # 2. 上传：优先私信，失败转存备份频道；每组上传完就释放它的缓冲区
+        try: dm = await self.user.create_dm()
+        except: dm = None
+        async def _upload(part, indexes):
+            await asyncio.gather(*[read_tasks[idx] for idx in indexes])
+            new_indexes = [idx for idx in indexes if not spooled_files[idx]['existing']]
+            group = [spooled_files[idx] for idx in new_indexes]
+            uploaded = {}
+            if group: uploaded = dict(zip(new_indexes, await _send_backup(part, group)))
+            # 新文件顺便存一份到本地存储，之后下载不必等 CDN
+            for f in group: await local_storage.put(f, f['fp'])
+            close_files([spooled_files[idx] for idx in indexes])
+            progress['sent'] += 1
+            await report()
+            entries = []
+            for idx in indexes:
+                entry = spooled_files[idx]['existing'] or uploaded.get(idx)
+                if entry: entries.append(dict(entry, filename=spooled_files[idx]['filename'], content_hash=spooled_files[idx]['content_hash']))
+            return entries
+
+        async def _send_backup(part, group):
+            part_note = f"（第 {part}/{len(batches)} 部分）" if len(batches) > 1 else ""
+            backup_msg = None
+            if dm:
+                try: backup_msg = await dm.send(content=f"【{self.draft_title}】的私信备份！{part_note}\nID: {interaction.id}\n(此消息仅作为文件源，请勿删除)", files=make_discord_files_common(group))
+                except: pass
+            if backup_msg is None:
                 # Fallback
                 fallback_channel = self.bot.get_channel(BACKUP_CHANNEL_ID)
                 if not fallback_channel: fallback_channel = await self.bot.fetch_channel(BACKUP_CHANNEL_ID)
-                backup_msg = await fallback_channel.send(content=f"📦 **备用存储** (DM Failed)\nUser: {self.user} ({self.user.id})\nTitle: {self.draft_title}", files=files_to_send)
-            
-            for i, att in enumerate(backup_msg.attachments):
-                real_display_name = self.custom_names.get(i, self.attachments[i].filename)
-                stored_data.append({
-                    "strategy": "msg_ref", "channel_id": backup_msg.channel.id, "message_id": backup_msg.id,
-                    "attachment_index": i, "filename": real_display_name, "url": att.url
-                })
-        except Exception as e: return await interaction.followup.send(f"备份发送失败：{e}", ephemeral=True)
+                backup_msg = await fallback_channel.send(content=f"📦 **备用存储** (DM Failed){part_note}\nUser: {self.user} ({self.user.id})\nTitle: {self.draft_title}", files=make_discord_files_common(group))
+            return [{
+                "strategy": "msg_ref", "channel_id": backup_msg.channel.id, "message_id": backup_msg.id,
+                "attachment_index": i, "url": att.url, "size": att.size
+            } for i, att in enumerate(backup_msg.attachments)]
+
+        upload_tasks = [asyncio.create_task(_upload(part, indexes)) for part, indexes in enumerate(batches, 1)]
+        stored_data = []
+        try:
+            for entries in await asyncio.gather(*upload_tasks):
+                stored_data += entries
+        except Exception as e:
+            for task in upload_tasks + read_tasks: task.cancel()
+            await asyncio.gather(*upload_tasks, *read_tasks, return_exceptions=True)
+            stage = "文件读取失败" if isinstance(e, IOError) else "备份发送失败"
+            return await interaction.followup.send(f"{stage}：{e}", ephemeral=True)
+        finally: close_files([f for f in spooled_files if f])
+        await report("⏳ 备份完成，正在发布面板...", force=True)
 
         if self.target_message:
             try: await self.target_message.delete()
@@ -450,16 +984,29 @@ class ProtectionDraftView(ui.View):
         try: await final_msg.pin(reason="附件保护自动标注")
         except: await interaction.followup.send("提示：我没有置顶权限！", ephemeral=True)
         
+        now_iso = datetime.now(TZ_SHANGHAI).isoformat()
         async with get_db() as db:
             await db.execute(
-                """INSERT INTO protected_items (message_id, channel_id, owner_id, unlock_type, storage_urls, title, log, password, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-                (final_msg.id, final_msg.channel.id, self.user.id, self.draft_mode, json.dumps(stored_data), self.draft_title, self.draft_log, self.draft_password, datetime.now(TZ_SHANGHAI).isoformat())
+                """INSERT INTO protected_items (message_id, channel_id, owner_id, unlock_type, title, log, password, created_at, last_seen_at, bundle) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
+                (final_msg.id, final_msg.channel.id, self.user.id, self.draft_mode, self.draft_title, self.draft_log, self.draft_password, now_iso, now_iso, int(self.draft_bundle))
+            )
+            await db.executemany(FILE_ROWS_SQL, file_rows(final_msg.id, stored_data))
+            # 新上传的文件登记进内容索引（同一内容以最新的备份为准）
+            await db.executemany(
+                "INSERT OR REPLACE INTO content_index (content_hash, size, backup_channel_id, backup_message_id, attachment_index, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(f['content_hash'], f['size'], f['channel_id'], f['message_id'], f['attachment_index'], now_iso) for f in stored_data if 'size' in f]
             )
             await db.commit()
+        protected_registry.add(final_msg.id, final_msg.channel.id)
+        asyncio.create_task(backfill_new_post(self.bot, final_msg.id, final_msg.channel.id))
+        if self.draft_bundle: asyncio.create_task(_prebuild_bundle(self.bot, stored_data))
         
         # 【修改点】发布时不再挂载 DownloadView，因为按钮已经去掉了
         # await final_msg.edit(view=DownloadView(self.bot)) -> 已移除
         
+        reuse_note = f"（其中 {progress['reused']} 个复用已有备份）" if progress['reused'] else ""
+        try: await interaction.edit_original_response(content=f"✅ 发布完成！共 {len(stored_data)} 个文件{reuse_note}。")
+        except: pass
         await interaction.followup.send("✅ 发布成功！已移除直接获取按钮，引导用户使用命令。", ephemeral=True)
 
 # --- Published Management ---
@@ -479,10 +1026,10 @@ class EditPublishedFileModal(ui.Modal, title="修改已发布文件名"):
         new_stem = self.name_input.value.strip()
         if not new_stem: return await interaction.response.send_message("文件名不能为空！", ephemeral=True)
         new_full_name = f"{new_stem}{self.ext}"
+        old_bundle = bundle_key(self.file_data)
         self.file_data[self.file_index]['filename'] = new_full_name
-        async with get_db() as db:
-            await db.execute("UPDATE protected_items SET storage_urls = ? WHERE message_id = ?", (json.dumps(self.file_data), self.message_id))
-            await db.commit()
+        await rename_post_file(self.message_id, self.file_index, new_full_name)
+        await bundle_builder.discard(old_bundle)  # 包里的文件名已经过时
         await interaction.response.send_message(f"✅ 修改成功！文件已更名为 `{new_full_name}`", ephemeral=True)
 
 class ManageFilesSelectView(ui.View):
@@ -502,18 +1049,28 @@ class ManageFilesSelectView(ui.View):
         await interaction.response.send_modal(EditPublishedFileModal(self.message_id, idx, self.file_data))
 
 class PostManagementView(ui.View):
-    def __init__(self, message_id, file_data):
+    def __init__(self, message_id, file_data, bundle=False):
         super().__init__(timeout=60)
         self.message_id = message_id
         self.file_data = file_data
+        self.bundle = bundle
+        self.toggle_bundle.label = f"🗜️ 打包下载：{'开' if bundle else '关'}"
     @ui.button(label="✏️ 修改文件名", style=discord.ButtonStyle.primary)
     async def rename_files(self, interaction: discord.Interaction, button: ui.Button):
         await interaction.response.send_message("请选择要修改的文件：", view=ManageFilesSelectView(self.message_id, self.file_data), ephemeral=True)
+    @ui.button(label="🗜️ 打包下载", style=discord.ButtonStyle.secondary)
+    async def toggle_bundle(self, interaction: discord.Interaction, button: ui.Button):
+        self.bundle = not self.bundle
+        async with get_db() as db:
+            await db.execute("UPDATE protected_items SET bundle = ? WHERE message_id = ?", (int(self.bundle), self.message_id))
+            await db.commit()
+        # 开启时先在后台打好包，第一个下载的人不用等
+        if self.bundle: asyncio.create_task(_prebuild_bundle(interaction.client, self.file_data))
+        button.label = f"🗜️ 打包下载：{'开' if self.bundle else '关'}"
+        await interaction.response.edit_message(view=self)
     @ui.button(label="🗑️ 删除帖子", style=discord.ButtonStyle.danger)
     async def delete_post(self, interaction: discord.Interaction, button: ui.Button):
-        async with get_db() as db: 
-            await db.execute("DELETE FROM protected_items WHERE message_id = ?", (self.message_id,))
-            await db.commit()
+        await forget_protected_posts([self.message_id])
         try: await (await interaction.channel.fetch_message(self.message_id)).delete()
         except: pass
         await interaction.response.edit_message(content="✅ 帖子已删除！", embed=None, view=None)
@@ -533,10 +1090,9 @@ class PostSelectionView(ui.View):
     async def on_select(self, interaction: discord.Interaction):
         mid_str = self.select.values[0]
         row = self.posts_map[mid_str]
-        try: file_data = json.loads(row['storage_urls'])
-        except: file_data = []
+        file_data = await load_post_files(row['message_id'])
         embed = discord.Embed(title=f"🔧 管理: {row['title']}", description="请选择操作：", color=0xffd700)
-        await interaction.response.edit_message(embed=embed, view=PostManagementView(row['message_id'], file_data))
+        await interaction.response.edit_message(embed=embed, view=PostManagementView(row['message_id'], file_data, bool(row['bundle'])))
 
 class PostListView(ui.View):
     def __init__(self, bot, posts_rows):
@@ -558,10 +1114,8 @@ class PostListView(ui.View):
         self.selected_row = next((p for p in self.posts if p['message_id'] == selected_id), None)
         if not self.selected_row: return await interaction.response.send_message("选择出错，请重试。", ephemeral=True)
         self.btn_download.disabled = False
-        try:
-            file_data = json.loads(self.selected_row['storage_urls'])
-            file_list = "\n".join([f"📄 {f.get('filename','???')}" for f in file_data])
-        except: file_list = "解析错误"
+        file_data = await load_post_files(selected_id)
+        file_list = "\n".join([f"📄 {f.get('filename','???')}" for f in file_data]) or "（没有文件记录）"
         mode_map = {"like": "👍 点赞", "like_comment": "👍💬 点赞+评论", "like_password": "👍🔐 点赞+口令", "like_comment_password": "👍💬🔐 全套验证"}
         embed = discord.Embed(title=f"📂 {self.selected_row['title']}", color=discord.Color.green())
         embed.add_field(name="📋 包含文件", value=file_list[:1000], inline=False)
@@ -581,9 +1135,11 @@ class PostListView(ui.View):
             # 如果是主人且没测试身份，直接给文件（跳过Delay）
             if interaction.user.id == row['owner_id'] and not has_test_role:
                  await interaction.response.defer(ephemeral=True, thinking=True)
-                 file_data = json.loads(row['storage_urls'])
+                 file_data = await load_post_files(row['message_id'])
                  file_results = await fetch_files_common(self.bot, file_data)
-                 if file_results: await interaction.followup.send(content="👑 主人请拿好：", files=make_discord_files_common(file_results), ephemeral=True)
+                 try:
+                     if file_results: await interaction.followup.send(content="👑 主人请拿好：", files=make_discord_files_common(file_results), ephemeral=True)
+                 finally: close_files(file_results)
                  return
             # 否则弹出密码框
             await interaction.response.send_modal(PasswordUnlockModal(row['password'], row, self.bot, unlock_type))
@@ -605,6 +1161,13 @@ class ProtectionCog(commands.Cog):
         self.ctx_menu = app_commands.ContextMenu(name="转为保护附件", callback=self.convert_to_protected)
         self.bot.tree.add_command(self.ctx_menu)
         self.bot.loop.create_task(init_likes_db())
+        self.bot.loop.create_task(protected_registry.load())
+        self.url_refresh_task.start()
+        storage_router.register(DiscordMessageBackend(bot))
+        self.mirror_task.start()
+        self.likes_backfill_lock = asyncio.Lock()
+        self.comments_backfill_lock = asyncio.Lock()
+        self.backfill_task.start()
 
     maker_group = app_commands.Group(name="贴主", description="[贴主] 附件保护发布与管理工具")
     user_group = app_commands.Group(name="保护附件", description="[用户] 下载与查询附件")
@@ -612,6 +1175,68 @@ class ProtectionCog(commands.Cog):
 
     async def cog_unload(self):
         self.bot.tree.remove_command(self.ctx_menu.name, type=self.ctx_menu.type)
+        self.url_refresh_task.cancel()
+        self.mirror_task.cancel()
+        self.backfill_task.cancel()
+
+    @tasks.loop(minutes=URL_REFRESH_INTERVAL_MINUTES)
+    async def url_refresh_task(self):
+        """定期为热门帖（下载量靠前 + 最近发布）提前刷新附件链接，用户下载时就不必再解析备份消息"""
+        recent_since = datetime.fromtimestamp(time.time() - URL_REFRESH_RECENT_DAYS * 86400, TZ_SHANGHAI).isoformat()
+        async with get_db() as db:
+            rows = await (await db.execute(
+                "SELECT message_id FROM protected_items ORDER BY download_count DESC LIMIT ?", (URL_REFRESH_HOT_POSTS,)
+            )).fetchall()
+            rows += await (await db.execute("SELECT message_id FROM protected_items WHERE created_at >= ?", (recent_since,))).fetchall()
+        message_ids = list(dict.fromkeys(r['message_id'] for r in rows))
+        try:
+            count = await refresh_stored_urls(self.bot, message_ids)
+            if count: print(f"已刷新 {count} 个附件链接")
+        except Exception as e: print(f"URL refresh error: {e}")
+
+    @url_refresh_task.before_loop
+    async def before_url_refresh(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=MIRROR_INTERVAL_HOURS)
+    async def mirror_task(self):
+        """定期把已发布的文件镜像到本地存储，并清理不再被引用的本地副本"""
+        try:
+            copied, failed = await mirror_to_local()
+            if copied or failed: print(f"本地镜像：复制 {copied} 个文件，失败 {failed} 个")
+            removed, freed = await collect_local_garbage()
+            if removed: print(f"本地存储清理：删除 {removed} 个无引用文件，释放 {freed / 1024 / 1024:.1f} MB")
+        except Exception as e: print(f"Mirror error: {e}")
+
+    @mirror_task.before_loop
+    async def before_mirror(self):
+        await self.bot.wait_until_ready()
+
+    async def _run_likes_backfill(self, full=False, progress=None):
+        async with self.likes_backfill_lock:
+            total, elapsed = await backfill_cached_likes(self.bot, full=full, progress=progress)
+        print(f"点赞回填完成：{total} 条，用时 {elapsed:.1f}s（{total / elapsed if elapsed else 0:.1f} 条/秒）")
+        return total, elapsed
+
+    async def _run_comments_backfill(self, full=False):
+        async with self.comments_backfill_lock:
+            total, threads, elapsed = await backfill_comments(self.bot, full=full)
+        print(f"评论回填完成：{threads} 个子区，{total} 条评论，用时 {elapsed:.1f}s")
+        return total, threads, elapsed
+
+    @tasks.loop(hours=BACKFILL_INTERVAL_HOURS)
+    async def backfill_task(self):
+        """定时增量回填保护贴首楼的点赞和子区内的评论"""
+        if not self.likes_backfill_lock.locked():
+            try: await self._run_likes_backfill()
+            except Exception as e: print(f"Likes backfill error: {e}")
+        if not self.comments_backfill_lock.locked():
+            try: await self._run_comments_backfill()
+            except Exception as e: print(f"Comments backfill error: {e}")
+
+    @backfill_task.before_loop
+    async def before_backfill(self):
+        await self.bot.wait_until_ready()
 
     async def _get_active_posts(self, channel, owner_id=None):
         sql = "SELECT * FROM protected_items WHERE channel_id = ?"
@@ -619,65 +1244,157 @@ class ProtectionCog(commands.Cog):
         if owner_id: sql += " AND owner_id = ?"; params += (owner_id,)
         sql += " ORDER BY created_at DESC"
         async with get_db() as db:
-            db.row_factory = aiosqlite.Row
             rows = await (await db.execute(sql, params)).fetchall()
-        active_posts, ids_to_clean = [], []
-        for row in rows:
-            try: await channel.fetch_message(row['message_id']); active_posts.append(row)
-            except discord.NotFound: ids_to_clean.append(row['message_id'])
-        if ids_to_clean:
-            async with get_db() as db: await db.executemany("DELETE FROM protected_items WHERE message_id = ?", [(i,) for i in ids_to_clean]); await db.commit()
-        return active_posts
+
+        # 删除事件会直接清掉记录，这里只需核实太久没确认过的帖子（例如 Bot 离线期间被删的）
+        now = datetime.now(TZ_SHANGHAI)
+        def _is_stale(row):
+            try: return (now - datetime.fromisoformat(row['last_seen_at'])).total_seconds() > POST_ALIVE_TTL_HOURS * 3600
+            except (TypeError, ValueError): return True
+        semaphore = asyncio.Semaphore(POST_CHECK_CONCURRENCY)
+        async def _check(row):
+            async with semaphore:
+                try: await channel.fetch_message(row['message_id']); return True
+                except discord.NotFound: return False
+                except discord.HTTPException: return None  # 无法确认，先当作存在，下次再查
+        stale = [row for row in rows if _is_stale(row)]
+        results = dict(zip([row['message_id'] for row in stale], await asyncio.gather(*[_check(row) for row in stale])))
+
+        alive_ids = [mid for mid, ok in results.items() if ok]
+        if alive_ids:
+            async with get_db() as db:
+                await db.executemany("UPDATE protected_items SET last_seen_at = ? WHERE message_id = ?", [(now.isoformat(), mid) for mid in alive_ids])
+                await db.commit()
+        ids_to_clean = [mid for mid, ok in results.items() if ok is False]
+        if ids_to_clean: await forget_protected_posts(ids_to_clean)
+        return [row for row in rows if results.get(row['message_id']) is not False]
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        await forget_protected_posts([payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        await forget_protected_posts(list(payload.message_ids))
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        if protected_registry.ready and payload.thread_id not in protected_registry.channel_counts: return
+        async with get_db() as db:
+            rows = await (await db.execute("SELECT message_id FROM protected_items WHERE channel_id = ?", (payload.thread_id,))).fetchall()
+        await forget_protected_posts([row['message_id'] for row in rows])
     
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         if payload.user_id == self.bot.user.id: return
-        async with get_db() as db:
-            await db.execute("INSERT OR IGNORE INTO user_likes (user_id, message_id) VALUES (?, ?)", (payload.user_id, payload.message_id))
-            await db.commit()
+        if not protected_registry.is_like_target(payload.message_id): return
+        likes_index.add(payload.message_id, payload.user_id, payload.guild_id)
+        write_queue.put(("like", payload.user_id, payload.message_id), "INSERT OR IGNORE INTO user_likes (user_id, message_id) VALUES (?, ?)", (payload.user_id, payload.message_id))
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        async with get_db() as db:
-            await db.execute("DELETE FROM user_likes WHERE user_id = ? AND message_id = ?", (payload.user_id, payload.message_id))
-            await db.commit()
+        if not protected_registry.is_like_target(payload.message_id): return
+        likes_index.remove(payload.message_id, payload.user_id, payload.guild_id)
+        write_queue.put(("like", payload.user_id, payload.message_id), "DELETE FROM user_likes WHERE user_id = ? AND message_id = ?", (payload.user_id, payload.message_id))
+        # 回填来的记录也要删，否则重启后 likes_index 从两张表的并集加载，取消的赞又回来了
+        write_queue.put(("cached_like", payload.user_id, payload.message_id), "DELETE FROM cached_likes WHERE message_id = ? AND user_id = ?", (payload.message_id, payload.user_id))
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         if message.author.bot: return
-        if isinstance(message.channel, discord.Thread) and is_valid_comment(message.content):
+        if not isinstance(message.channel, discord.Thread) or not protected_registry.is_comment_target(message.channel.id): return
+        if is_valid_comment(message.content):
             thread_id = message.channel.id 
-            async with get_db() as db:
-                await db.execute("INSERT OR REPLACE INTO user_comments (user_id, message_id, content) VALUES (?, ?, ?)", (message.author.id, thread_id, message.content[:50]))
-                await db.commit()
+            write_queue.put(("comment", message.author.id, thread_id), "INSERT OR REPLACE INTO user_comments (user_id, message_id, content) VALUES (?, ?, ?)", (message.author.id, thread_id, message.content[:50]))
 
     @admin_group.command(name="修复面板", description="移除本频道所有旧面板的按钮（改用命令）")
     async def fix_panels(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         async with get_db() as db:
-            db.row_factory = aiosqlite.Row
             rows = await (await db.execute("SELECT * FROM protected_items WHERE channel_id = ?", (interaction.channel.id,))).fetchall()
         if not rows: return await interaction.followup.send("本频道在数据库中没有活跃记录。", ephemeral=True)
-        success_count, fail_count = 0, 0
-        for row in rows:
-            try:
-                msg = await interaction.channel.fetch_message(row['message_id'])
-                # 清除View，移除按钮
-                await msg.edit(view=None)
-                success_count += 1
-                await asyncio.sleep(1.0) 
-            except: fail_count += 1
-        await interaction.followup.send(f"✅ 修复完成！\n已移除按钮的消息: {success_count} 个\n失败/已删除: {fail_count} 个", ephemeral=True)
+        channel = interaction.channel
+        # 清除View，移除按钮；直接按消息 ID 编辑，不用先 fetch
+        items = [(("edit", channel.id), lambda mid=row['message_id']: channel.get_partial_message(mid).edit(view=None)) for row in rows]
+        last_edit = 0
+        async def progress(job):
+            nonlocal last_edit
+            if job.elapsed - last_edit < 3: return
+            last_edit = job.elapsed
+            try: await interaction.edit_original_response(content=f"⏳ 修复中... {job.describe()}")
+            except: pass
+        job = await scheduler.run_all("修复面板", items, progress=progress)
+        await interaction.followup.send(f"✅ 修复完成！\n已移除按钮的消息: {job.done} 个\n失败/已删除: {job.failed} 个\n用时 {job.elapsed:.1f}s", ephemeral=True)
+
+    @admin_group.command(name="缓存状态", description="查看附件本地缓存的命中率与容量")
+    async def cache_stats(self, interaction: discord.Interaction):
+        st = attachment_cache.stats()
+        embed = discord.Embed(title="🗄️ 附件缓存状态", color=0x87ceeb)
+        embed.add_field(name="命中 / 未命中", value=f"{st['hits']} / {st['misses']} (命中率 {st['hit_rate']:.1%})", inline=False)
+        embed.add_field(name="淘汰次数", value=str(st['evictions']), inline=True)
+        embed.add_field(name="条目 / 文件", value=f"{st['entries']} / {st['blobs']}", inline=True)
+        embed.add_field(name="占用", value=f"{st['bytes'] / 1024**2:.1f} MB / {st['max_bytes'] / 1024**2:.0f} MB", inline=True)
+        url_st = attachment_url_cache.stats()
+        embed.add_field(name="链接缓存 (命中/未命中/合并)", value=f"{url_st['hits']} / {url_st['misses']} / {url_st['coalesced']}，共 {url_st['entries']} 条", inline=False)
+        starter_st = starter_cache.stats()
+        embed.add_field(name="首楼缓存 (命中/未命中/合并)", value=f"{starter_st['hits']} / {starter_st['misses']} / {starter_st['coalesced']} (命中率 {starter_st['hit_rate']:.1%})，共 {starter_st['entries']} 条；网关直接提供 {starter_st['gateway']} 次", inline=False)
+        lines = []
+        for backend in storage_router.ordered():
+            b_st = backend.stats()
+            latency = f"{b_st['latency'] * 1000:.0f}ms" if b_st['latency'] is not None else "—"
+            lines.append(f"{'🟢' if b_st['healthy'] else '🔴'} **{backend.name}**：平均 {latency}，读取 {b_st['reads']} 次，失败 {b_st['errors']} 次")
+        local_count, local_bytes = await local_storage.usage()
+        lines.append(f"本地存储：{local_count} 个文件，{local_bytes / 1024**2:.1f} MB")
+        embed.add_field(name="存储后端", value="\n".join(lines), inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @admin_group.command(name="回填点赞", description="把保护贴首楼上已有的点赞补录进数据库")
+    @app_commands.describe(full="从头重扫（默认只补录上次之后新增的）")
+    async def backfill_likes_cmd(self, interaction: discord.Interaction, full: bool = False):
+        if self.likes_backfill_lock.locked(): return await interaction.response.send_message("⏳ 已有回填任务在运行，请稍后再试。", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        last_edit = 0
+        async def progress(total, elapsed):
+            nonlocal last_edit
+            if elapsed - last_edit < 3: return
+            last_edit = elapsed
+            try: await interaction.edit_original_response(content=f"⏳ 回填中... 已写入 {total} 条（{total / elapsed:.1f} 条/秒）")
+            except: pass
+        try: total, elapsed = await self._run_likes_backfill(full=full, progress=progress)
+        except Exception as e: return await interaction.followup.send(f"❌ 回填失败：{e}", ephemeral=True)
+        rate = total / elapsed if elapsed else 0
+        try: await interaction.edit_original_response(content=f"✅ 回填完成！共写入 {total} 条点赞，用时 {elapsed:.1f}s（{rate:.1f} 条/秒）")
+        except: pass
+
+    @admin_group.command(name="回填评论", description="把含保护贴的子区里已有的评论补录进数据库")
+    @app_commands.describe(full="从头重读（默认只读上次之后的新消息）")
+    async def backfill_comments_cmd(self, interaction: discord.Interaction, full: bool = False):
+        if self.comments_backfill_lock.locked(): return await interaction.response.send_message("⏳ 已有回填任务在运行，请稍后再试。", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        try: total, threads, elapsed = await self._run_comments_backfill(full=full)
+        except Exception as e: return await interaction.followup.send(f"❌ 回填失败：{e}", ephemeral=True)
+        try: await interaction.followup.send(f"✅ 回填完成！处理 {threads} 个子区，写入 {total} 条评论，用时 {elapsed:.1f}s", ephemeral=True)
+        except: pass
+
+    @admin_group.command(name="点赞索引状态", description="查看内存点赞索引的规模与内存占用")
+    async def likes_index_stats(self, interaction: discord.Interaction):
+        stats = likes_index.memory_by_guild()
+        embed = discord.Embed(title="👍 点赞索引状态", color=0x87ceeb)
+        st = stats.get(interaction.guild_id, {"messages": 0, "likes": 0, "bytes": 0})
+        embed.add_field(name="本服务器", value=f"消息 {st['messages']} 条 / 点赞 {st['likes']} 个 / 约 {st['bytes'] / 1024:.1f} KB", inline=False)
+        total_bytes = sum(v['bytes'] for v in stats.values())
+        embed.add_field(name="全部服务器", value=f"{len(stats)} 个服务器，共约 {total_bytes / 1024:.1f} KB", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @user_group.command(name="今日下载记录", description="查询今日下载历史和剩余次数")
     async def my_downloads_today(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         today_start_iso = datetime.now(TZ_SHANGHAI).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+        download_count = await quota_ledger.get(interaction.user.id)
         async with get_db() as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT title, filenames, timestamp FROM download_log WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp DESC", (interaction.user.id, today_start_iso))
+            # 次数取自额度账本；明细只取最近 20 条（嵌入字段最多 1024 字，再多也显示不下）
+            cursor = await db.execute("SELECT title, filenames, timestamp FROM download_log WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp DESC LIMIT 20", (interaction.user.id, today_start_iso))
             logs = await cursor.fetchall()
-        download_count = len(logs)
         remaining = DAILY_DOWNLOAD_LIMIT - download_count
         embed = discord.Embed(title=f"📜 {interaction.user.display_name} 的今日下载记录", color=discord.Color.blue())
         embed.description = f"**今日下载次数**: {download_count}/{DAILY_DOWNLOAD_LIMIT}\n**剩余次数**: {remaining}"
@@ -695,7 +1412,6 @@ class ProtectionCog(commands.Cog):
     @user_group.command(name="获取附件", description="显示本频道最近的5个受保护附件列表")
     async def get_attachments_list(self, interaction: discord.Interaction):
         async with get_db() as db:
-            db.row_factory = aiosqlite.Row
             cursor = await db.execute("SELECT * FROM protected_items WHERE channel_id = ? ORDER BY created_at DESC LIMIT 5", (interaction.channel.id,))
             rows = await cursor.fetchall()
         if not rows: return await interaction.response.send_message("❌ 本频道没有任何受保护的附件记录。", ephemeral=True)
@@ -1,12 +1,13 @@
 import discord
 from discord import app_commands, ui
 from discord.ext import commands, tasks
-import aiosqlite
-import random
 import asyncio
 from datetime import datetime, time
 from zoneinfo import ZoneInfo
 from database import get_db
+from scheduler import scheduler
+from thread_index import thread_index, ThreadRecord
+from starter_cache import starter_cache
 
 # === 配置 ===
 TZ_SHANGHAI = ZoneInfo("Asia/Shanghai")
@@ -39,7 +40,6 @@ async def check_user_drawn_today(user_id: int) -> bool:
     """检查用户今天是否已经抽过卡"""
     today_str = datetime.now(TZ_SHANGHAI).strftime("%Y-%m-%d")
     async with get_db() as db:
-        db.row_factory = aiosqlite.Row
         cursor = await db.execute("SELECT last_draw_date FROM daily_gacha_records WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         
@@ -66,30 +66,34 @@ def get_card_forums(guild: discord.Guild):
     # 只要频道名包含列表中的任意一个关键词，就纳入池子
     return [c for c in guild.forums if any(keyword in c.name for keyword in TARGET_KEYWORDS)]
 
-async def get_random_thread_pool(guild: discord.Guild, specific_channel_id=None):
-    """获取符合条件的帖子池 (排除置顶帖)"""
+async def get_random_thread_pool(guild: discord.Guild, count: int, specific_channel_id=None):
+    """
+    从帖子库里随机抽取 count 个符合条件的帖子 (排除置顶帖，归档帖也在池子里)。
+    归档帖会换成真正的 Thread；已被删除的帖子在这一步移出库并补抽，最多补抽 3 轮。
+    """
     forums = get_card_forums(guild)
     if specific_channel_id:
         forums = [f for f in forums if f.id == int(specific_channel_id)]
-    
-    threads = []
-    for forum in forums:
-        for thread in forum.threads:
-            # 排除置顶帖
-            if thread.flags.pinned:
-                continue
-            threads.append(thread)
-            
-    return threads
+    forum_ids = [f.id for f in forums]
+
+    drawn = {}
+    for _ in range(3):
+        if len(drawn) >= count: break
+        candidates = await thread_index.load(guild, await thread_index.random_ids(forum_ids, count - len(drawn)))
+        if not candidates: break
+        for thread in candidates:
+            if thread.id in drawn: continue
+            if isinstance(thread, ThreadRecord): thread = await thread.resolve()
+            if thread: drawn[thread.id] = thread
+    return list(drawn.values())
 
 async def fetch_thread_details(thread: discord.Thread):
     """获取帖子的详细信息 (优化版)"""
-    starter = thread.starter_message
-    if not starter:
-        try:
-            async for msg in thread.history(limit=1, oldest_first=True):
-                starter = msg; break
-        except: pass
+    # 归档帖先换成真正的 Thread 才能取首楼
+    if isinstance(thread, ThreadRecord): thread = await thread.resolve() or thread
+    # 首楼走共享缓存，同一个帖子被反复抽到时不再重复请求
+    try: starter = await starter_cache.get(thread)
+    except: starter = None
     
     intro = "（暂无介绍）"
     image_url = None
@@ -129,7 +133,7 @@ async def fetch_thread_details(thread: discord.Thread):
         "author_mention": author_mention,
         "author_avatar": author_avatar,
         "intro": intro,
-        "category": thread.parent.name,
+        "category": thread.parent.name if thread.parent else "未知分区",
         "tags": tags,
         "url": thread.jump_url,
         "image": image_url
@@ -175,13 +179,11 @@ class GachaControlView(ui.View):
         
         await interaction.response.defer(ephemeral=True)
         
-        threads = await get_random_thread_pool(interaction.guild, self.selected_channel_id)
-        if not threads:
+        drawn_threads = await get_random_thread_pool(interaction.guild, count, self.selected_channel_id)
+        if not drawn_threads:
             return await interaction.followup.send("🏜️ 当前选择的卡池里空空如也... (或是只有置顶帖)", ephemeral=True)
             
-        if len(threads) < count: count = len(threads)
-            
-        drawn_threads = random.sample(threads, count)
+        count = len(drawn_threads)
         
         if not is_tester:
             await mark_user_drawn(interaction.user.id)
@@ -261,12 +263,13 @@ class RecommendCog(commands.Cog):
     async def _cleanup_old_messages(self, channel):
         """删除旧的推荐消息"""
         try:
+            old_msgs = []
             async for msg in channel.history(limit=20):
                 if msg.author == self.bot.user and msg.embeds:
                     # 【修改】这里只要标题包含 "每日精选" 就匹配，兼容旧的 "每日精选角色"
                     if "每日精选" in msg.embeds[0].title:
-                        await msg.delete()
-                        await asyncio.sleep(0.5)
+                        old_msgs.append(msg)
+            await scheduler.run_all("清理每日精选", [(("delete", channel.id), msg.delete) for msg in old_msgs])
         except Exception as e: print(f"Cleanup error: {e}")
 
     async def refresh_recommendation_panel(self, channel, mode="edit"):
@@ -276,7 +279,7 @@ class RecommendCog(commands.Cog):
         mode="reset": 强制删除旧消息并发送新的（用于手动命令）
         """
         # 1. 获取数据
-        pool = await get_random_thread_pool(channel.guild)
+        pool = await get_random_thread_pool(channel.guild, 1)
         if not pool:
             # 如果池子空了，发个提示
             error_embed = discord.Embed(title="📅 每日推荐", description="今天资源库里空空如也捏...", color=0x99aab5)
@@ -285,7 +288,7 @@ class RecommendCog(commands.Cog):
                 await channel.send(embed=error_embed)
             return
 
-        target_thread = random.choice(pool)
+        target_thread = pool[0]
         info = await fetch_thread_details(target_thread)
         
         # 2. 构建 Embed
@@ -333,13 +336,12 @@ class RecommendCog(commands.Cog):
     @tasks.loop(time=time(hour=0, minute=0, tzinfo=TZ_SHANGHAI))
     async def daily_recommend_task(self):
         """每天0点自动刷新 (编辑模式)"""
-        # 【修改】支持多频道推送
-        for channel_id in DAILY_RECOMMEND_CHANNEL_ID:
-            channel = self.bot.get_channel(channel_id)
-            if channel:
-                # 使用 mode="edit" 以保持频道整洁
-                await self.refresh_recommendation_panel(channel, mode="edit")
-                await asyncio.sleep(2) # 防止速率限制
+        # 【修改】支持多频道推送，各频道并行刷新（限速交给 discord.py 和调度器，不再固定等待）
+        channels = [self.bot.get_channel(channel_id) for channel_id in DAILY_RECOMMEND_CHANNEL_ID]
+        # 使用 mode="edit" 以保持频道整洁
+        results = await asyncio.gather(*[self.refresh_recommendation_panel(channel, mode="edit") for channel in channels if channel], return_exceptions=True)
+        for e in results:
+            if isinstance(e, Exception): print(f"Daily recommend refresh failed: {e}")
 
     @daily_recommend_task.before_loop
     async def before_daily_task(self):
@@ -1,13 +1,82 @@
 # database.py
 
+import asyncio
+import json
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
 import aiosqlite
 
+from search_tokens import index_text
+
 DB_NAME = "chimidan.db"
+# 数据库结构版本（PRAGMA user_version），用于判断一次性迁移是否已经做过
+SCHEMA_VERSION = 3
+
+# 长连接的性能参数：WAL 允许读写并发，NORMAL 在 WAL 下只在检查点时 fsync
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",      # 约 16MB 页缓存
+    "PRAGMA mmap_size = 134217728",    # 128MB 内存映射
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# 高频事件（点赞/评论）的批量落库参数：每隔多少秒或攒够多少条提交一次
+WRITE_FLUSH_INTERVAL = 0.5
+WRITE_FLUSH_MAX_PENDING = 200
+
+# 下载记录写入队列：最多排队多少条（满了 put 会等待）、每个事务最多写多少条、失败后多久重试
+DOWNLOAD_LOG_QUEUE_SIZE = 1000
+DOWNLOAD_LOG_BATCH_SIZE = 200
+DOWNLOAD_LOG_RETRY_DELAY = 1.0
+
+_conn: aiosqlite.Connection = None
+_conn_lock = asyncio.Lock()
+_closed = False   # close_db 之后置位：关闭过程中还没结束的任务再来借连接时直接报错，不悄悄重连
+
+async def open_db() -> aiosqlite.Connection:
+    """打开全局共享连接（只在启动时真正连接一次）；close_db 之后调用抛 RuntimeError"""
+    global _conn
+    if _closed: raise RuntimeError("数据库连接已关闭")
+    if _conn is None:
+        conn = await aiosqlite.connect(DB_NAME)
+        conn.row_factory = aiosqlite.Row
+        # 帖子搜索的全文索引由触发器调用这个函数分词
+        await conn.create_function("search_tokens", 1, index_text, deterministic=True)
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        _conn = conn
+    return _conn
+
+async def close_db():
+    """
+    关闭全局连接，在 Bot 关闭时调用：先把批量队列和下载记录队列里的写入落盘，
+    每一步单独兜底，某一步失败也照样关闭连接（没关掉的连接线程会让进程退不出去）。
+    """
+    global _conn, _closed
+    try:
+        try: await write_queue.close()
+        except Exception as e: print(f"关闭时批量写入落盘失败: {e}")
+        try: await download_log_writer.close()
+        except Exception as e: print(f"关闭时下载记录落盘失败: {e}")
+    finally:
+        _closed = True
+        async with _conn_lock:
+            if _conn is not None:
+                conn, _conn = _conn, None
+                try: await conn.commit()
+                except Exception as e: print(f"关闭时提交失败: {e}")
+                finally: await conn.close()
 
 async def init_db():
     print("🔄正在检查并初始化数据库...")
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    await open_db()
+    async with get_db() as db:
+        version = (await (await db.execute("PRAGMA user_version")).fetchone())[0]
         
         # 1. 保护贴主表
         await db.execute("""
@@ -47,13 +116,289 @@ async def init_db():
             )
         """)
         
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_likes_message ON user_likes (message_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_download_log_user_time ON download_log (user_id, timestamp)")
+
+        # 5. 每日下载额度账本（按上海日期），与 download_log 在同一事务内递增
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS download_quota (
+                user_id INTEGER, day TEXT, count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+        """)
+
+        # 6. 保护贴文件表：每个附件一行，取代 protected_items.storage_urls 里的 JSON
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS protected_files (
+                message_id INTEGER, file_index INTEGER, filename TEXT, strategy TEXT,
+                backup_channel_id INTEGER, backup_message_id INTEGER, attachment_index INTEGER, url TEXT,
+                content_hash TEXT,
+                PRIMARY KEY (message_id, file_index)
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_protected_files_backup ON protected_files (backup_channel_id, backup_message_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_protected_files_url ON protected_files (url)")
+
+        # 7. 内容索引：文件 sha256 -> 已经上传过的备份附件，重复发布同样的文件时直接引用
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS content_index (
+                content_hash TEXT PRIMARY KEY, size INTEGER,
+                backup_channel_id INTEGER, backup_message_id INTEGER, attachment_index INTEGER, created_at TEXT
+            )
+        """)
+
+        # 8. 论坛帖子搜索库：帖子元数据 + 首楼内容，全文索引放在外部内容的 FTS5 表里，由触发器同步
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS thread_search (
+                thread_id INTEGER PRIMARY KEY, forum_id INTEGER, owner_id INTEGER,
+                title TEXT NOT NULL DEFAULT '', content TEXT, created_at REAL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_thread_search_forum ON thread_search (forum_id, created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_thread_search_owner ON thread_search (owner_id, created_at)")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS thread_tags (
+                thread_id INTEGER, tag_id INTEGER,
+                PRIMARY KEY (thread_id, tag_id)
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_thread_tags_tag ON thread_tags (tag_id)")
+        # 全文索引存的是 search_tokens() 切好的片段（见 search_tokens.py），不保存原文（contentless），
+        # 删除旧条目时由触发器按旧的原文重新分词。版本 1 用的是 trigram 分词器，升级时重建。
+        if version < 2:
+            for trigger in ("thread_search_ai", "thread_search_ad", "thread_search_au"):
+                await db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            await db.execute("DROP TABLE IF EXISTS thread_search_fts")
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS thread_search_fts USING fts5(
+                title, content, content='', tokenize='unicode61'
+            )
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS thread_search_ai AFTER INSERT ON thread_search BEGIN
+                INSERT INTO thread_search_fts (rowid, title, content) VALUES (new.thread_id, search_tokens(new.title), search_tokens(new.content));
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS thread_search_ad AFTER DELETE ON thread_search BEGIN
+                INSERT INTO thread_search_fts (thread_search_fts, rowid, title, content) VALUES ('delete', old.thread_id, search_tokens(old.title), search_tokens(old.content));
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS thread_search_au AFTER UPDATE OF title, content ON thread_search
+            WHEN old.title IS NOT new.title OR old.content IS NOT new.content BEGIN
+                INSERT INTO thread_search_fts (thread_search_fts, rowid, title, content) VALUES ('delete', old.thread_id, search_tokens(old.title), search_tokens(old.content));
+                INSERT INTO thread_search_fts (rowid, title, content) VALUES (new.thread_id, search_tokens(new.title), search_tokens(new.content));
+            END
+        """)
+        if version < 2:
+            await db.execute("INSERT INTO thread_search_fts (rowid, title, content) SELECT thread_id, search_tokens(title), search_tokens(content) FROM thread_search")
+        # 每个论坛的归档爬取进度（具体的列在下面补）
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS thread_sync_state (
+                forum_id INTEGER PRIMARY KEY
+            )
+        """)
+        # 归档帖也收录进来：archived/pinned 标记；归档爬取的进度（游标、已收录的最新归档时间、是否翻到底）
+        # 以及归档帖存活检查轮到的帖子 ID
+        for table, column in (
+            ("thread_search", "archived INTEGER DEFAULT 0"), ("thread_search", "pinned INTEGER DEFAULT 0"),
+            ("thread_sync_state", "archive_before REAL"), ("thread_sync_state", "archive_newest REAL"),
+            ("thread_sync_state", "archive_done INTEGER DEFAULT 0"), ("thread_sync_state", "archive_checked INTEGER"),
+        ):
+            try: await db.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            except Exception: pass
+
         try: 
             await db.execute("ALTER TABLE protected_items ADD COLUMN created_at TEXT")
         except Exception: 
             pass 
+        # 保护贴最近一次被确认仍然存在的时间；已删除的帖子由删除事件直接清掉
+        try: await db.execute("ALTER TABLE protected_items ADD COLUMN last_seen_at TEXT")
+        except Exception: pass
+        # 打包下载：开启后下载时发送整包 zip
+        try: await db.execute("ALTER TABLE protected_items ADD COLUMN bundle INTEGER DEFAULT 0")
+        except Exception: pass
+        try: await db.execute("ALTER TABLE protected_files ADD COLUMN content_hash TEXT")
+        except Exception: pass
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_protected_files_hash ON protected_files (content_hash)")
         
+        if version < 1: await _migrate_storage_urls(db)
+        if version < 3: await _seed_download_quota(db)
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         await db.commit()
+    write_queue.start()
+    download_log_writer.start()
     print("✅ 数据库初始化完成，表结构已就绪。")
 
-def get_db():
-    return aiosqlite.connect(DB_NAME)
+def file_rows(message_id, file_data):
+    """把旧的 storage_urls 列表（或发布时构造的同结构列表）转成 protected_files 的行"""
+    if not isinstance(file_data, list): return []
+    items = [f for f in file_data if isinstance(f, dict)]
+    return [(
+        message_id, i, f.get('filename', 'unknown'), f.get('strategy'),
+        f.get('channel_id'), f.get('message_id'), f.get('attachment_index', 0), f.get('url'), f.get('content_hash')
+    ) for i, f in enumerate(items)]
+
+# file_rows 对应的插入语句
+FILE_ROWS_SQL = """INSERT OR IGNORE INTO protected_files
+    (message_id, file_index, filename, strategy, backup_channel_id, backup_message_id, attachment_index, url, content_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+async def _migrate_storage_urls(db):
+    """一次性迁移：把 protected_items.storage_urls 的 JSON 拆成 protected_files 的行（旧列保留不删）"""
+    rows = await (await db.execute("SELECT message_id, storage_urls FROM protected_items WHERE storage_urls IS NOT NULL")).fetchall()
+    migrated = []
+    for row in rows:
+        try: migrated += file_rows(row['message_id'], json.loads(row['storage_urls']))
+        except (TypeError, ValueError): print(f"storage_urls 解析失败，跳过: {row['message_id']}")
+    await db.executemany(FILE_ROWS_SQL, migrated)
+    print(f"📦 已迁移 {len(rows)} 个保护贴的 {len(migrated)} 个文件到 protected_files")
+
+async def _seed_download_quota(db):
+    """一次性迁移：额度账本上线前的今日下载记录补记进 download_quota（已有账本行的用户不会被覆盖）"""
+    today = datetime.now(ZoneInfo("Asia/Shanghai"))
+    today_start = today.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    await db.execute(
+        "INSERT OR IGNORE INTO download_quota (user_id, day, count) SELECT user_id, ?, COUNT(*) FROM download_log WHERE timestamp >= ? GROUP BY user_id",
+        (today.strftime("%Y-%m-%d"), today_start)
+    )
+
+@asynccontextmanager
+async def get_db():
+    """
+    借用全局共享连接。
+    持有期间独占连接，保证同一个 async with 块内的语句和 commit 不会和其他协程交错；
+    块内抛异常时自动回滚未提交的写入。块内不要再嵌套调用 get_db()。
+    """
+    conn = await open_db()
+    async with _conn_lock:
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+
+class WriteBehindQueue:
+    """
+    Write-behind 批量写入队列：把高频的单行写入攒起来，在一个事务里提交。
+    同一个 key 只保留最后一次写入，例如同一用户对同一消息先点赞再取消，最终只落一条 DELETE。
+    """
+    def __init__(self, flush_interval=WRITE_FLUSH_INTERVAL, max_pending=WRITE_FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def put(self, key, sql, params):
+        self._pending.pop(key, None)
+        self._pending[key] = (sql, params)
+        if len(self._pending) >= self.max_pending: self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            try: await self.flush()
+            except Exception as e: print(f"批量写入失败，稍后重试: {e}")
+
+    async def flush(self):
+        if not self._pending: return
+        batch, self._pending = self._pending, {}
+        grouped = {}
+        for sql, params in batch.values():
+            grouped.setdefault(sql, []).append(params)
+        try:
+            async with get_db() as db:
+                for sql, rows in grouped.items():
+                    await db.executemany(sql, rows)
+                await db.commit()
+        except Exception:
+            # 放回队列等下次重试，期间同 key 的新写入优先
+            for key, op in batch.items(): self._pending.setdefault(key, op)
+            raise
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+write_queue = WriteBehindQueue()
+
+class DownloadLogWriter:
+    """
+    下载记录的单一后台写入器。
+    每次下载产生一条 (user_id, message_id, title, filenames, timestamp, day)，排进有界队列（满了 put 会等待，形成背压）；
+    后台任务一次取出一批，在一个事务里按 message_id 合并 download_count 增量、批量插入 download_log、按用户合并当日额度。
+    """
+    def __init__(self, maxsize=DOWNLOAD_LOG_QUEUE_SIZE, batch_size=DOWNLOAD_LOG_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = asyncio.Queue(maxsize)
+        self._task = None
+        self._closing = False
+
+    async def put(self, user_id, message_id, title, filenames, timestamp, day):
+        await self._queue.put((user_id, message_id, title, filenames, timestamp, day))
+
+    def start(self):
+        self._closing = False
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            while True:
+                try:
+                    await self._write(batch)
+                    break
+                except Exception as e:
+                    if self._closing:
+                        print(f"下载记录写入失败，丢弃 {len(batch)} 条: {e}")
+                        break
+                    print(f"下载记录写入失败，稍后重试: {e}")
+                    await asyncio.sleep(DOWNLOAD_LOG_RETRY_DELAY)
+            for _ in batch: self._queue.task_done()
+
+    @staticmethod
+    async def _write(batch):
+        counts = Counter(entry[1] for entry in batch)
+        quotas = Counter((entry[0], entry[5]) for entry in batch)
+        async with get_db() as db:
+            await db.executemany("UPDATE protected_items SET download_count = download_count + ? WHERE message_id = ?", [(n, mid) for mid, n in counts.items()])
+            await db.executemany("INSERT INTO download_log (user_id, message_id, title, filenames, timestamp) VALUES (?, ?, ?, ?, ?)", [entry[:5] for entry in batch])
+            await db.executemany(
+                "INSERT INTO download_quota (user_id, day, count) VALUES (?, ?, ?) ON CONFLICT (user_id, day) DO UPDATE SET count = count + excluded.count",
+                [(uid, day, n) for (uid, day), n in quotas.items()]
+            )
+            await db.commit()
+
+    async def close(self):
+        """等队列里的记录全部写完再停止后台任务"""
+        self._closing = True
+        if self._task and not self._task.done():
+            await self._queue.join()
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+        self._task = None
+        # 后台任务没在运行时（例如启动失败）直接在这里写完剩下的
+        batch = []
+        while not self._queue.empty(): batch.append(self._queue.get_nowait())
+        if batch:
+            try: await self._write(batch)
+            except Exception as e: print(f"下载记录写入失败，丢弃 {len(batch)} 条: {e}")
+            for _ in batch: self._queue.task_done()
+
+download_log_writer = DownloadLogWriter()
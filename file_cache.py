@@ -0,0 +1,221 @@
+# file_cache.py
+
+import asyncio
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+from spooling import CHUNK_SIZE
+
+# 受保护附件的本地磁盘缓存目录与容量上限（字节）
+CACHE_DIR = os.path.join("cache", "attachments")
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+def hash_file(fp):
+    """流式计算可 seek 文件对象的 sha256（与缓存 blob 的命名一致），完成后回到开头"""
+    fp.seek(0)
+    digest = hashlib.sha256()
+    while chunk := fp.read(CHUNK_SIZE): digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+class AttachmentCache:
+    """
+    内容寻址的附件磁盘缓存，按 LRU 淘汰。
+    blobs/<sha256> 存文件内容，keys/<缓存键> 里记录对应的 sha256，
+    同一份内容被多个帖子引用时只存一份；某个 blob 不再被任何键引用时才删除。
+    LRU 顺序用键文件的 mtime 持久化，重启后可以恢复。
+    每个 blob 在本次运行中第一次被读取时校验 sha256（本次运行写入的 blob 写入时已经算过），之后只比对大小。
+    读写都是文件句柄，不会把整个附件读进内存。
+    """
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(root, "blobs")
+        self.key_dir = os.path.join(root, "keys")
+        self._keys = OrderedDict()  # 缓存键 -> sha256，越靠后越新
+        self._blob_sizes = {}       # sha256 -> 字节数
+        self._blob_refs = {}        # sha256 -> 引用计数
+        self._verified = set()      # 本次运行中已经校验过内容的 sha256
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(item):
+        """
+        附件的缓存键：已知内容哈希的按哈希（内容相同的附件共用一个条目），
+        否则按 msg_ref 的 (channel_id, message_id, attachment_index)；没有引用信息的旧数据不缓存
+        """
+        if not isinstance(item, dict): return None
+        if item.get('content_hash'): return f"h_{item['content_hash']}"
+        if item.get('strategy') != 'msg_ref': return None
+        cid, mid = item.get('channel_id'), item.get('message_id')
+        if not (cid and mid): return None
+        return f"{cid}_{mid}_{item.get('attachment_index', 0)}"
+
+    @property
+    def total_bytes(self):
+        return sum(self._blob_sizes.values())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._keys), "blobs": len(self._blob_sizes),
+            "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+        }
+
+    # --- 磁盘操作（都在线程里执行，避免阻塞事件循环） ---
+
+    def _scan(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
+        blob_sizes = {name: os.path.getsize(os.path.join(self.blob_dir, name)) for name in os.listdir(self.blob_dir)}
+        entries = []
+        for name in os.listdir(self.key_dir):
+            path = os.path.join(self.key_dir, name)
+            try:
+                with open(path, "r") as f: sha = f.read().strip()
+                mtime = os.path.getmtime(path)
+            except OSError: continue
+            if sha in blob_sizes: entries.append((mtime, name, sha))
+            else:
+                try: os.remove(path)
+                except OSError: pass
+        entries.sort()
+        return blob_sizes, entries
+
+    def _open_blob(self, key, sha, size, verify):
+        fp = open(os.path.join(self.blob_dir, sha), "rb")
+        if os.fstat(fp.fileno()).st_size != size:
+            fp.close()
+            raise OSError(f"缓存文件大小不符: {sha}")
+        if verify and hash_file(fp) != sha:
+            fp.close()
+            raise OSError(f"缓存文件内容校验失败: {sha}")
+        os.utime(os.path.join(self.key_dir, key))
+        return fp
+
+    def _write_entry(self, key, src):
+        """边复制边计算 sha256，写完再按哈希落到 blobs/ 下，返回 (sha256, 字节数)"""
+        src.seek(0)
+        digest, size = hashlib.sha256(), 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := src.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            sha = digest.hexdigest()
+            blob_path = os.path.join(self.blob_dir, sha)
+            if os.path.exists(blob_path): os.remove(tmp_path)
+            else: os.replace(tmp_path, blob_path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+        finally:
+            src.seek(0)
+        with open(os.path.join(self.key_dir, key), "w") as f: f.write(sha)
+        return sha, size
+
+    def _remove_files(self, key=None, sha=None):
+        paths = []
+        if key: paths.append(os.path.join(self.key_dir, key))
+        if sha: paths.append(os.path.join(self.blob_dir, sha))
+        for path in paths:
+            try: os.remove(path)
+            except OSError: pass
+
+    # --- 内存索引 ---
+
+    async def _ensure_loaded(self):
+        if self._loaded: return
+        async with self._load_lock:
+            if self._loaded: return
+            blob_sizes, entries = await asyncio.to_thread(self._scan)
+            for _, key, sha in entries:
+                self._keys[key] = sha
+                self._blob_refs[sha] = self._blob_refs.get(sha, 0) + 1
+            self._blob_sizes = {sha: size for sha, size in blob_sizes.items() if sha in self._blob_refs}
+            orphans = [sha for sha in blob_sizes if sha not in self._blob_refs]
+            self._loaded = True
+        for sha in orphans:
+            await asyncio.to_thread(self._remove_files, None, sha)
+
+    def _unlink_key(self, key):
+        """从索引中移除一个键，返回已经没有引用、需要删除的 blob"""
+        sha = self._keys.pop(key, None)
+        if sha is None: return None
+        self._blob_refs[sha] -= 1
+        if self._blob_refs[sha] > 0: return None
+        del self._blob_refs[sha]
+        self._blob_sizes.pop(sha, None)
+        return sha
+
+    async def _drop(self, key):
+        sha = self._unlink_key(key)
+        self._verified.discard(sha)
+        await asyncio.to_thread(self._remove_files, key, sha)
+
+    async def _evict(self):
+        while self.total_bytes > self.max_bytes and self._keys:
+            key = next(iter(self._keys))
+            await self._drop(key)
+            self.evictions += 1
+
+    # --- 对外接口 ---
+
+    async def open(self, key):
+        """命中时返回只读文件句柄（调用方负责关闭），未命中返回 None"""
+        if not key: return None
+        await self._ensure_loaded()
+        sha = self._keys.get(key)
+        if sha is None:
+            self.misses += 1
+            return None
+        try:
+            fp = await asyncio.to_thread(self._open_blob, key, sha, self._blob_sizes.get(sha), sha not in self._verified)
+        except OSError as e:
+            print(f"Cache Error: {e}")
+            await self._drop(key)
+            self.misses += 1
+            return None
+        self._verified.add(sha)
+        if key in self._keys: self._keys.move_to_end(key)
+        self.hits += 1
+        return fp
+
+    async def put_file(self, key, src, size_hint=None):
+        """把可 seek 的文件对象 src 存进缓存，完成后 src 回到开头；返回内容的 sha256"""
+        if not key or (size_hint and size_hint > self.max_bytes): return None
+        await self._ensure_loaded()
+        try:
+            sha, size = await asyncio.to_thread(self._write_entry, key, src)
+        except OSError as e:
+            print(f"Cache Error: {e}")
+            return None
+        old_blob = self._unlink_key(key)
+        if old_blob and old_blob != sha:
+            self._verified.discard(old_blob)
+            await asyncio.to_thread(self._remove_files, None, old_blob)
+        self._keys[key] = sha
+        self._blob_refs[sha] = self._blob_refs.get(sha, 0) + 1
+        self._blob_sizes[sha] = size
+        self._verified.add(sha)
+        await self._evict()
+        return sha
+
+    async def discard(self, key):
+        """主动删除一个条目（例如内容已经过时的打包文件）"""
+        if not key: return
+        await self._ensure_loaded()
+        if key in self._keys: await self._drop(key)
+
+attachment_cache = AttachmentCache()
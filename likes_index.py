@@ -0,0 +1,96 @@
+# likes_index.py
+
+import asyncio
+import sys
+from array import array
+from bisect import bisect_left
+
+from database import get_db, write_queue
+
+class LikesIndex:
+    """
+    “用户 X 是否点赞过消息 Y”的内存索引。
+    每条消息一个有序的 array('Q')（每个用户 ID 占 8 字节），首次查询时从 user_likes 与 cached_likes 懒加载，
+    之后由点赞监听器实时增删，查询不再访问数据库。
+    取消点赞时监听器会同时删掉 user_likes 和 cached_likes 里的记录，所以内存里的结果和重启后从库里加载的一致。
+    """
+    def __init__(self):
+        self._likes = {}    # message_id -> 有序 array('Q')
+        self._guilds = {}   # message_id -> guild_id，用于按服务器统计内存
+        self._loading = {}  # message_id -> 加载任务
+        self._pending = {}  # message_id -> 加载期间收到的 [(是否点赞, user_id)]
+
+    @staticmethod
+    def _contains(arr, user_id):
+        i = bisect_left(arr, user_id)
+        return i < len(arr) and arr[i] == user_id
+
+    @staticmethod
+    def _apply(arr, is_add, user_id):
+        i = bisect_left(arr, user_id)
+        found = i < len(arr) and arr[i] == user_id
+        if is_add and not found: arr.insert(i, user_id)
+        elif not is_add and found: del arr[i]
+
+    def _update(self, message_id, user_id, is_add, guild_id=None):
+        if guild_id: self._guilds.setdefault(message_id, guild_id)
+        if message_id in self._loading:
+            self._pending.setdefault(message_id, []).append((is_add, user_id))
+            return
+        arr = self._likes.get(message_id)
+        # 还没加载过的消息不用记，首次查询时会从数据库读到
+        if arr is not None: self._apply(arr, is_add, user_id)
+
+    def add(self, message_id, user_id, guild_id=None):
+        self._update(message_id, user_id, True, guild_id)
+
+    def remove(self, message_id, user_id, guild_id=None):
+        self._update(message_id, user_id, False, guild_id)
+
+    def add_many(self, message_id, user_ids, guild_id=None):
+        for user_id in user_ids: self._update(message_id, user_id, True, guild_id)
+
+    async def has_liked(self, message_id, user_id, guild_id=None) -> bool:
+        if guild_id: self._guilds.setdefault(message_id, guild_id)
+        arr = self._likes.get(message_id)
+        if arr is None:
+            task = self._loading.get(message_id)
+            if task is None:
+                task = asyncio.ensure_future(self._load(message_id))
+                self._loading[message_id] = task
+            arr = await asyncio.shield(task)
+        return self._contains(arr, user_id)
+
+    async def _load(self, message_id):
+        try:
+            # 先让批量队列里还没落库的点赞写进去，加载期间新到的事件记在 _pending 里随后补上
+            await write_queue.flush()
+            async with get_db() as db:
+                rows = await (await db.execute(
+                    "SELECT user_id FROM user_likes WHERE message_id = ? UNION SELECT user_id FROM cached_likes WHERE message_id = ?",
+                    (message_id, message_id)
+                )).fetchall()
+            arr = array('Q', sorted(row[0] for row in rows))
+            for is_add, user_id in self._pending.get(message_id, []):
+                self._apply(arr, is_add, user_id)
+            self._likes[message_id] = arr
+            return arr
+        finally:
+            self._loading.pop(message_id, None)
+            self._pending.pop(message_id, None)
+
+    def discard(self, message_id):
+        self._likes.pop(message_id, None)
+        self._guilds.pop(message_id, None)
+
+    def memory_by_guild(self):
+        """按服务器统计：{guild_id: {"messages": 消息数, "likes": 点赞数, "bytes": 估算字节数}}"""
+        stats = {}
+        for message_id, arr in self._likes.items():
+            st = stats.setdefault(self._guilds.get(message_id), {"messages": 0, "likes": 0, "bytes": 0})
+            st["messages"] += 1
+            st["likes"] += len(arr)
+            st["bytes"] += sys.getsizeof(arr)
+        return stats
+
+likes_index = LikesIndex()
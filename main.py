@@ -4,7 +4,9 @@ import os
 from dotenv import load_dotenv
 import aiohttp
 
-from database import init_db
+from database import init_db, close_db
+from scheduler import scheduler
+from bundles import close_pool
 
 load_dotenv()
 
@@ -39,6 +41,9 @@ class ChimidanBot(commands.Bot):
         await super().close()
         if self.http_session:
             await self.http_session.close()
+        await scheduler.close()
+        close_pool()
+        await close_db()
 
 bot = ChimidanBot()
 
@@ -0,0 +1,144 @@
+# scheduler.py
+
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+# 同时执行的出站请求上限（不同路由之间并行，同一路由内串行）
+SCHEDULER_MAX_PARALLEL = 8
+# 单个任务遇到 429 时最多重试几次
+SCHEDULER_MAX_RETRIES = 5
+# 429 响应里没有 Retry-After 时的默认等待秒数
+SCHEDULER_DEFAULT_RETRY_AFTER = 1.0
+
+def _retry_after(e):
+    """从 429 异常里取出需要等待的秒数，不是 429 返回 None"""
+    if isinstance(e, discord.RateLimited): return e.retry_after
+    if isinstance(e, discord.HTTPException) and e.status == 429:
+        headers = getattr(e.response, 'headers', None) or {}
+        try: return float(headers.get('Retry-After') or headers.get('X-RateLimit-Reset-After'))
+        except (TypeError, ValueError): return SCHEDULER_DEFAULT_RETRY_AFTER
+    return None
+
+class BulkJob:
+    """一批出站操作的进度：完成数、失败数与按当前速度估算的剩余时间"""
+    def __init__(self, name, total=0):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def finished(self):
+        return self.done + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def eta(self):
+        """预计剩余秒数，还没有完成任何一项时返回 None"""
+        if not self.finished: return None
+        return max(0.0, (self.total - self.finished) * self.elapsed / self.finished)
+
+    def describe(self):
+        pct = self.finished / self.total if self.total else 1.0
+        eta = self.eta()
+        text = f"{self.finished}/{self.total}（{pct:.0%}）"
+        if self.failed: text += f"，失败 {self.failed}"
+        if eta is not None and self.finished < self.total: text += f"，预计剩余 {eta:.0f}s"
+        return text
+
+class OutboundScheduler:
+    """
+    出站 Discord 操作（发送/编辑/删除）的统一调度器，取代各处手写的 asyncio.sleep。
+    任务按路由键排队：同一路由（例如同一频道的删除）串行执行，不同路由并行。
+    discord.py 本身会按响应头里的 X-RateLimit-* 在每个 bucket 上限速，这里再负责把
+    最终抛出的 429 按 Retry-After 冷却整条路由后重试，并给长时间的批量任务提供进度。
+    """
+    def __init__(self, max_parallel=SCHEDULER_MAX_PARALLEL, max_retries=SCHEDULER_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_parallel)
+        self._queues = {}          # 路由键 -> deque[(协程工厂, future, BulkJob, 已重试次数)]
+        self._workers = {}         # 路由键 -> 执行任务
+        self._blocked_until = {}   # 路由键 -> 冷却结束的 monotonic 时间
+        self.completed = 0
+        self.rate_limited = 0
+
+    def stats(self):
+        return {
+            "routes": len(self._workers), "queued": sum(len(q) for q in self._queues.values()),
+            "completed": self.completed, "rate_limited": self.rate_limited,
+        }
+
+    def submit(self, route, factory, job=None) -> asyncio.Future:
+        """
+        提交一个出站操作。route 是任意可哈希的路由键，约定写成 ("delete", channel_id) 这样的元组；
+        factory 是无参协程函数（每次重试都会重新调用）。返回可 await 的 future。
+        factory 里只放单个 REST 调用，不要再等待其他调度任务，否则会占着并发名额互相等待。
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(route, deque()).append((factory, future, job, 0))
+        worker = self._workers.get(route)
+        if worker is None or worker.done():
+            self._workers[route] = asyncio.create_task(self._run_route(route))
+        return future
+
+    async def run_all(self, name, items, progress=None):
+        """
+        批量提交 [(route, factory), ...] 并等待全部完成，单项失败不影响其他项。
+        progress(job) 在每完成一项后调用。返回 BulkJob。
+        """
+        job = BulkJob(name, len(items))
+        futures = [self.submit(route, factory, job) for route, factory in items]
+        for future in asyncio.as_completed(futures):
+            try: await future
+            except Exception: pass
+            if progress: await progress(job)
+        return job
+
+    async def _run_route(self, route):
+        queue = self._queues[route]
+        try:
+            while queue:
+                factory, future, job, attempt = queue.popleft()
+                if future.cancelled(): continue
+                wait = self._blocked_until.get(route, 0) - time.monotonic()
+                if wait > 0: await asyncio.sleep(wait)
+                try:
+                    async with self._semaphore:
+                        result = await factory()
+                except Exception as e:
+                    retry_after = _retry_after(e)
+                    if retry_after is not None and attempt < self.max_retries:
+                        self.rate_limited += 1
+                        self._blocked_until[route] = time.monotonic() + retry_after
+                        queue.appendleft((factory, future, job, attempt + 1))
+                        continue
+                    if job: job.failed += 1
+                    if not future.done(): future.set_exception(e)
+                    continue
+                self.completed += 1
+                if job: job.done += 1
+                if not future.done(): future.set_result(result)
+        finally:
+            if not queue:
+                self._queues.pop(route, None)
+                self._blocked_until.pop(route, None)
+            if self._workers.get(route) is asyncio.current_task(): self._workers.pop(route, None)
+
+    async def close(self):
+        """Bot 关闭时取消所有排队中的操作"""
+        workers = list(self._workers.values())
+        for worker in workers: worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in self._queues.values():
+            for _, future, _, _ in queue:
+                if not future.done(): future.cancel()
+        self._queues.clear()
+        self._workers.clear()
+
+scheduler = OutboundScheduler()
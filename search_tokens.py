@@ -0,0 +1,38 @@
+# search_tokens.py
+
+import re
+
+# 中日韩文字（汉字、假名、谚文），这些文字之间没有空格，按字切 n-gram
+CJK = r"[ぁ-ゖァ-ヺー-ヿ㐀-䶿一-鿿豈-﫿가-힯]"
+_TOKEN_RE = re.compile(rf"({CJK}+)|((?:(?!{CJK})[^\W_])+)")
+
+def _ngrams(run, n):
+    return [run[i:i + n] for i in range(len(run) - n + 1)]
+
+def index_text(text):
+    """
+    建索引用的分词结果（空格分隔，交给 FTS5 的 unicode61 分词器原样切开）：
+    中日韩连续文字输出所有 2 字和 3 字片段，其他文字按词输出小写形式。
+    """
+    if not text: return ""
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text.lower()):
+        if cjk: tokens += _ngrams(cjk, 2) + _ngrams(cjk, 3)
+        else: tokens.append(word)
+    return " ".join(tokens)
+
+def match_query(keyword):
+    """
+    把关键词转成 FTS5 的 MATCH 表达式（各项之间是 AND），关键词里没有可用的片段时返回 None。
+    中文 2 个字查 2-gram、3 个字以上查全部 3-gram；其他文字按词前缀匹配。
+    单个汉字没有对应的片段，由调用方用子串比较兜底。
+    """
+    terms = []
+    for cjk, word in _TOKEN_RE.findall((keyword or "").lower()):
+        if cjk: terms += [f'"{gram}"' for gram in (_ngrams(cjk, 3) if len(cjk) >= 3 else _ngrams(cjk, 2))]
+        else: terms.append(f'"{word}"*')
+    return " ".join(dict.fromkeys(terms)) or None
+
+def has_word_terms(keyword):
+    """关键词里是否有非中日韩的词：这些词在索引里只能按词前缀匹配，词中间的片段（如 hello 里的 llo）查不到"""
+    return any(word for _, word in _TOKEN_RE.findall((keyword or "").lower()))
@@ -0,0 +1,61 @@
+# spooling.py
+
+import tempfile
+
+# 单个文件在内存里最多停留的大小，超过后自动落盘到临时文件
+SPOOL_MEMORY_THRESHOLD = 8 * 1024 * 1024
+# 全进程同时驻留在内存里的文件数据上限
+INFLIGHT_MEMORY_BUDGET = 256 * 1024 * 1024
+# 流式读写的分块大小
+CHUNK_SIZE = 64 * 1024
+
+class MemoryBudget:
+    """全局内存额度。额度不够时不排队等待，而是让文件直接写磁盘，避免并发下载互相卡死"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def try_acquire(self, n) -> bool:
+        if self.used + n > self.limit: return False
+        self.used += n
+        return True
+
+    def release(self, n):
+        self.used = max(0, self.used - n)
+
+memory_budget = MemoryBudget(INFLIGHT_MEMORY_BUDGET)
+
+class BudgetedSpool(tempfile.SpooledTemporaryFile):
+    """占用全局内存额度的 SpooledTemporaryFile，close() 时归还额度并删除临时文件"""
+    def __init__(self, reserved):
+        super().__init__(max_size=reserved)
+        self._reserved = reserved
+        if not reserved: self.rollover()
+
+    def close(self):
+        super().close()
+        if self._reserved:
+            memory_budget.release(self._reserved)
+            self._reserved = 0
+
+def open_spool(size_hint=None) -> BudgetedSpool:
+    """
+    新建一个临时文件缓冲区。
+    已知大小超过阈值、或全局内存额度不足时直接落盘，否则先放在内存里。
+    """
+    reserve = min(size_hint or SPOOL_MEMORY_THRESHOLD, SPOOL_MEMORY_THRESHOLD)
+    if (size_hint and size_hint > SPOOL_MEMORY_THRESHOLD) or not memory_budget.try_acquire(reserve):
+        reserve = 0
+    return BudgetedSpool(reserve)
+
+def close_files(file_results):
+    """
+    发送完毕后释放 fetch 出来的文件句柄和内存额度。
+    discord.File 会把 fp.close 替换成空函数，这里先去掉这个替换再真正关闭。
+    """
+    for res in file_results:
+        fp = res.get('fp')
+        if fp is None: continue
+        vars(fp).pop('close', None)
+        try: fp.close()
+        except Exception: pass
@@ -0,0 +1,84 @@
+# starter_cache.py
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+from cdn import URL_EXPIRY_MARGIN, url_expires_at
+
+# 最多缓存多少个帖子的首楼，超过时淘汰最久没用过的
+STARTER_CACHE_SIZE = 2000
+# 首楼的缓存时长（秒）；带附件时不超过附件签名链接的有效期，免得展示出过期的图片
+STARTER_CACHE_TTL = 6 * 3600
+
+class StarterMessageCache:
+    """
+    论坛帖子首楼消息的共享 LRU 缓存，按帖子 ID（论坛帖的首楼消息 ID 与帖子 ID 相同）索引，
+    抽卡、每日精选和搜索库同步共用。同一帖子的并发请求只拉取一次；首楼已被删除时缓存 None，避免反复请求。
+    首楼被编辑、帖子更新或删除时由监听器调用 invalidate。
+    """
+    def __init__(self, maxsize=STARTER_CACHE_SIZE, ttl=STARTER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # thread_id -> (失效时间, 首楼消息 或 None)
+        self._inflight = {}            # thread_id -> 正在进行的拉取任务
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.gateway = 0   # 网关缓存里直接带着首楼、没查本缓存的次数，不计入命中率
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "gateway": self.gateway, "entries": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _valid_until(self, message):
+        valid_until = time.time() + self.ttl
+        expiries = [ex for ex in (url_expires_at(att.url) for att in (message.attachments if message else [])) if ex]
+        if expiries: valid_until = min(valid_until, min(expiries) - URL_EXPIRY_MARGIN)
+        return valid_until
+
+    def put(self, thread_id, message):
+        self._entries.pop(thread_id, None)
+        self._entries[thread_id] = (self._valid_until(message), message)
+        while len(self._entries) > self.maxsize: self._entries.popitem(last=False)
+
+    def invalidate(self, thread_id):
+        self._entries.pop(thread_id, None)
+        # 正在进行的拉取结果作废，不再写回缓存
+        self._inflight.pop(thread_id, None)
+
+    async def get(self, thread):
+        """返回帖子的首楼消息，首楼不存在时返回 None；网关缓存里有的直接用"""
+        if thread.starter_message:
+            self.gateway += 1
+            return thread.starter_message
+        entry = self._entries.get(thread.id)
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            self._entries.move_to_end(thread.id)
+            return entry[1]
+        task = self._inflight.get(thread.id)
+        if task: self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(thread))
+            self._inflight[thread.id] = task
+        # shield：某个等待者被取消时不影响其他合并进来的请求
+        return await asyncio.shield(task)
+
+    async def _load(self, thread):
+        task = asyncio.current_task()
+        try:
+            try: message = await thread.fetch_message(thread.id)
+            except discord.NotFound: message = None
+            if self._inflight.get(thread.id) is task: self.put(thread.id, message)
+            return message
+        finally:
+            if self._inflight.get(thread.id) is task: del self._inflight[thread.id]
+
+starter_cache = StarterMessageCache()
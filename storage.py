@@ -0,0 +1,191 @@
+# storage.py
+
+import abc
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+from spooling import CHUNK_SIZE
+
+# 本地内容寻址存储的目录（不按容量淘汰，只清理已经没有保护贴引用的文件）
+LOCAL_STORAGE_DIR = os.path.join("storage", "objects")
+# 清理时跳过最近多少秒内写入的文件：发布时先写本地副本、后写数据库记录，刚写入的文件可能还没有被引用
+LOCAL_GC_GRACE = 24 * 3600
+# 连续失败多少次视为不健康、不健康后多少秒内只作为最后的备选
+BACKEND_FAILURE_THRESHOLD = 3
+BACKEND_COOLDOWN = 60
+# 平均延迟的平滑系数（指数移动平均）
+LATENCY_SMOOTHING = 0.2
+
+class StorageBackend(abc.ABC):
+    """
+    受保护文件的存储后端接口，item 是 load_post_files 返回的条目。
+    open(item)：返回只读、可 seek 的文件对象（调用方负责关闭）；后端里没有这份文件返回 None，后端故障时抛异常。
+    put(item, fp)：保存一份副本，成功返回 True；只读的后端直接返回 False。
+    """
+    name = "base"
+
+    def __init__(self):
+        self.latency = None       # 成功读取的平均耗时（秒）
+        self.failures = 0         # 连续失败次数
+        self.down_until = 0
+        self.reads = 0
+        self.errors = 0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def record_success(self, elapsed):
+        self.reads += 1
+        self.failures = 0
+        self.latency = elapsed if self.latency is None else self.latency + LATENCY_SMOOTHING * (elapsed - self.latency)
+
+    def record_failure(self):
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= BACKEND_FAILURE_THRESHOLD:
+            self.down_until = time.monotonic() + BACKEND_COOLDOWN
+            self.failures = 0
+
+    def stats(self):
+        return {"healthy": self.healthy, "latency": self.latency, "reads": self.reads, "errors": self.errors}
+
+    @abc.abstractmethod
+    async def open(self, item): ...
+
+    async def put(self, item, fp) -> bool:
+        return False
+
+class LocalFilesystemBackend(StorageBackend):
+    """
+    本地内容寻址存储：objects/<sha256 前两位>/<sha256>。
+    只保存已知 content_hash 的文件，写入时校验哈希；同一内容只存一份。
+    保护贴删除后文件不会立刻删，由 collect_garbage 定期清理没有引用的文件。
+    """
+    name = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_DIR):
+        super().__init__()
+        self.root = root
+
+    def _path(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def has(self, sha) -> bool:
+        return bool(sha) and os.path.exists(self._path(sha))
+
+    def _write(self, sha, fp):
+        """边复制边校验 sha256，内容不符时放弃写入"""
+        path = self._path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fp.seek(0)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := fp.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    out.write(chunk)
+            if digest.hexdigest() != sha: raise ValueError(f"内容哈希不符: {sha}")
+            os.replace(tmp_path, path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+        finally:
+            fp.seek(0)
+
+    def _usage(self):
+        count, size = 0, 0
+        if not os.path.isdir(self.root): return count, size
+        for prefix in os.listdir(self.root):
+            folder = os.path.join(self.root, prefix)
+            if not os.path.isdir(folder): continue
+            for name in os.listdir(folder):
+                if name.startswith(".tmp-"): continue
+                count += 1
+                size += os.path.getsize(os.path.join(folder, name))
+        return count, size
+
+    async def usage(self):
+        """(文件数, 字节数)"""
+        return await asyncio.to_thread(self._usage)
+
+    def _collect_garbage(self, referenced, grace):
+        count, size = 0, 0
+        if not os.path.isdir(self.root): return count, size
+        cutoff = time.time() - grace
+        for prefix in os.listdir(self.root):
+            folder = os.path.join(self.root, prefix)
+            if not os.path.isdir(folder): continue
+            for name in os.listdir(folder):
+                # 写到一半中断留下的临时文件同样按宽限期清理
+                if name in referenced and not name.startswith(".tmp-"): continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime > cutoff: continue
+                    os.remove(path)
+                except OSError: continue
+                count += 1
+                size += stat.st_size
+        return count, size
+
+    async def collect_garbage(self, referenced, grace=LOCAL_GC_GRACE):
+        """删掉不在 referenced（仍被引用的 content_hash 集合）里、且写入已超过宽限期的文件，返回 (文件数, 字节数)"""
+        return await asyncio.to_thread(self._collect_garbage, set(referenced), grace)
+
+    async def open(self, item):
+        sha = item.get('content_hash')
+        if not sha: return None
+        try: return await asyncio.to_thread(open, self._path(sha), "rb")
+        except FileNotFoundError: return None
+
+    async def put(self, item, fp) -> bool:
+        sha = item.get('content_hash')
+        if not sha: return False
+        if await asyncio.to_thread(self.has, sha): return True
+        try: await asyncio.to_thread(self._write, sha, fp)
+        except (OSError, ValueError) as e:
+            print(f"Local Storage Error: {e}")
+            return False
+        return True
+
+class StorageRouter:
+    """
+    读取时按后端的健康状况和平均延迟排序，依次尝试，直到有一个后端拿到文件。
+    不健康的后端排在最后，只有其他后端都拿不到时才会再试。
+    """
+    def __init__(self, backends=()):
+        self.backends = list(backends)
+
+    def register(self, backend):
+        self.backends = [b for b in self.backends if b.name != backend.name] + [backend]
+
+    def get(self, name):
+        return next((b for b in self.backends if b.name == name), None)
+
+    def ordered(self):
+        # 还没有延迟数据的后端按 0 算，先试一次
+        by_latency = sorted(self.backends, key=lambda b: b.latency or 0)
+        return [b for b in by_latency if b.healthy] + [b for b in by_latency if not b.healthy]
+
+    async def open(self, item):
+        """返回 (文件对象, 提供它的后端)，都拿不到时返回 (None, None)"""
+        for backend in self.ordered():
+            started = time.monotonic()
+            try: fp = await backend.open(item)
+            except Exception as e:
+                backend.record_failure()
+                print(f"Storage Error ({backend.name}): {e}")
+                continue
+            if fp is None: continue
+            backend.record_success(time.monotonic() - started)
+            return fp, backend
+        return None, None
+
+local_storage = LocalFilesystemBackend()
+storage_router = StorageRouter([local_storage])
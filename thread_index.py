@@ -0,0 +1,351 @@
+# thread_index.py
+
+import asyncio
+from datetime import datetime, timezone
+
+import discord
+
+from database import get_db
+from search_tokens import has_word_terms, match_query
+
+# 相关度排序时标题命中的权重（bm25 的列权重：标题, 首楼内容）
+TITLE_WEIGHT = 10.0
+# 归档帖按页写库（和 API 每页 100 条一致），每页提交时一起保存爬取游标
+ARCHIVE_CRAWL_PAGE_SIZE = 100
+# 启动同步时确认“不在在线列表里的帖子”是归档还是已删除，同时查询的并发数
+SYNC_CHECK_CONCURRENCY = 8
+
+UPSERT_SQL = """INSERT INTO thread_search (thread_id, forum_id, owner_id, title, content, created_at, archived, pinned) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(thread_id) DO UPDATE SET forum_id = excluded.forum_id, owner_id = excluded.owner_id, title = excluded.title,
+    created_at = excluded.created_at, archived = excluded.archived, pinned = excluded.pinned,
+    content = COALESCE(excluded.content, thread_search.content)"""
+
+def _like_pattern(keyword):
+    return "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _placeholders(values):
+    return ",".join("?" * len(values))
+
+def _timestamp(dt):
+    return dt.timestamp() if dt else None
+
+class ThreadRecord:
+    """
+    库里的帖子元数据，提供列表展示用到的 discord.Thread 属性（name、owner、parent、applied_tags、jump_url 等）。
+    归档帖不在网关缓存里，搜索、日报、抽卡拿到的就是它；需要首楼等完整信息时用 resolve() 换成真正的 Thread。
+    """
+    starter_message = None
+
+    def __init__(self, guild, row, tag_ids=()):
+        self.guild = guild
+        self.id = row['thread_id']
+        self.parent_id = row['forum_id']
+        self.owner_id = row['owner_id']
+        self.name = row['title']
+        self.created_at = datetime.fromtimestamp(row['created_at'], timezone.utc) if row['created_at'] else None
+        self.archived = bool(row['archived'])
+        self.pinned = bool(row['pinned'])
+        self._tag_ids = list(tag_ids)
+
+    @property
+    def owner(self):
+        return self.guild.get_member(self.owner_id) if self.owner_id else None
+
+    @property
+    def parent(self):
+        return self.guild.get_channel(self.parent_id)
+
+    @property
+    def applied_tags(self):
+        parent = self.parent
+        if not hasattr(parent, 'get_tag'): return []
+        return [tag for tag in (parent.get_tag(tag_id) for tag_id in self._tag_ids) if tag]
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild.id}/{self.id}"
+
+    async def resolve(self):
+        """
+        换成真正的 discord.Thread（归档帖需要一次 API 调用）。
+        帖子已被删除时把它移出库并返回 None，调用方应丢弃这一条；其他原因拿不到时返回自己。
+        """
+        thread = self.guild.get_thread(self.id)
+        if thread: return thread
+        try: return await self.guild.fetch_channel(self.id)
+        except discord.NotFound:
+            await thread_index.remove(self.id)
+            return None
+        except Exception: return self
+
+class ThreadSearchIndex:
+    """
+    论坛帖子的持久化搜索库：thread_search 存帖子元数据与首楼内容，thread_tags 存标签，
+    thread_search_fts 是由触发器同步的 FTS5 全文索引（中日韩文字按 2/3 字片段、其他文字按词，见 search_tokens.py）。
+    平时随网关事件增量更新；启动时按论坛对照完整的在线帖子列表同步，只为库里还没有首楼内容的帖子调用 API。
+    归档帖由 crawl_archived 分批补进来（只存元数据），verify_archived 轮流确认它们是否已被删除，进度都记在 thread_sync_state 里。
+    """
+    def __init__(self):
+        self.ready = False   # 启动同步是否已经完成
+
+    @staticmethod
+    def _row(thread, content=None):
+        return (thread.id, thread.parent_id, thread.owner_id, thread.name or "", content,
+                _timestamp(thread.created_at), int(bool(thread.archived)), int(thread.flags.pinned))
+
+    @classmethod
+    async def _write(cls, db, entries):
+        """entries: [(thread, 首楼内容 或 None)]，内容为 None 时保留库里已有的内容"""
+        if not entries: return
+        await db.executemany(UPSERT_SQL, [cls._row(thread, content) for thread, content in entries])
+        await db.executemany("DELETE FROM thread_tags WHERE thread_id = ?", [(thread.id,) for thread, _ in entries])
+        await db.executemany("INSERT OR IGNORE INTO thread_tags (thread_id, tag_id) VALUES (?, ?)",
+                             [(thread.id, tag.id) for thread, _ in entries for tag in thread.applied_tags])
+
+    @staticmethod
+    async def _delete(db, thread_ids):
+        if not thread_ids: return
+        params = [(thread_id,) for thread_id in thread_ids]
+        await db.executemany("DELETE FROM thread_search WHERE thread_id = ?", params)
+        await db.executemany("DELETE FROM thread_tags WHERE thread_id = ?", params)
+
+    async def upsert(self, thread, content=None):
+        async with get_db() as db:
+            await self._write(db, [(thread, content)])
+            await db.commit()
+
+    async def set_content(self, thread_id, content):
+        """更新首楼内容（首楼被编辑），库里没有的帖子忽略"""
+        async with get_db() as db:
+            await db.execute("UPDATE thread_search SET content = ? WHERE thread_id = ?", (content or "", thread_id))
+            await db.commit()
+
+    async def has_content(self, thread_id) -> bool:
+        async with get_db() as db:
+            row = await (await db.execute("SELECT content IS NOT NULL FROM thread_search WHERE thread_id = ?", (thread_id,))).fetchone()
+        return bool(row and row[0])
+
+    async def remove(self, thread_id):
+        async with get_db() as db:
+            await self._delete(db, [thread_id])
+            await db.commit()
+
+    @staticmethod
+    async def _save_state(db, forum_id, **state):
+        columns = list(state)
+        await db.execute(
+            f"INSERT INTO thread_sync_state (forum_id, {', '.join(columns)}) VALUES (?, {_placeholders(columns)}) "
+            f"ON CONFLICT(forum_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+            (forum_id, *state.values())
+        )
+
+    async def sync_forum(self, forum, fetch_content):
+        """
+        把一个论坛的在线帖子同步进库：刷新元数据；库里有、在线列表里没有的帖子逐个向接口确认，
+        已归档的标记为归档，已删除的（例如 Bot 离线期间被删）移出库，查询失败的留到下次再确认；
+        再并发调用 fetch_content(thread) 补齐库里没有首楼内容的帖子（返回 None 表示这次没拿到，下次启动再试）。
+        返回 (帖子数, 拉取首楼的帖子数)。
+        """
+        threads = list(forum.threads)
+        live = {thread.id for thread in threads}
+        async with get_db() as db:
+            rows = await (await db.execute(
+                "SELECT thread_id, content IS NOT NULL AS loaded FROM thread_search WHERE forum_id = ? AND archived = 0", (forum.id,)
+            )).fetchall()
+        status = await self._check_missing(forum.guild, [row['thread_id'] for row in rows if row['thread_id'] not in live])
+        async with get_db() as db:
+            await self._delete(db, [thread_id for thread_id, state in status.items() if state == "deleted"])
+            await db.executemany("UPDATE thread_search SET archived = 1 WHERE thread_id = ?",
+                                 [(thread_id,) for thread_id, state in status.items() if state == "archived"])
+            await self._write(db, [(thread, None) for thread in threads])
+            await db.commit()
+        loaded = {row['thread_id'] for row in rows if row['loaded']}
+        pending = [thread for thread in threads if thread.id not in loaded]
+        contents = await asyncio.gather(*[fetch_content(thread) for thread in pending])
+        async with get_db() as db:
+            await db.executemany("UPDATE thread_search SET content = ? WHERE thread_id = ?",
+                                 [(content, thread.id) for content, thread in zip(contents, pending) if content is not None])
+            await db.commit()
+        return len(threads), len(pending)
+
+    @staticmethod
+    async def _check_missing(guild, thread_ids):
+        """向接口确认这些帖子的状态：{thread_id: "archived" / "deleted" / "active" / "unknown"}"""
+        sem = asyncio.Semaphore(SYNC_CHECK_CONCURRENCY)
+
+        async def check(thread_id):
+            async with sem:
+                try: channel = await guild.fetch_channel(thread_id)
+                except discord.NotFound: return thread_id, "deleted"
+                except Exception: return thread_id, "unknown"
+            return thread_id, "archived" if getattr(channel, 'archived', False) else "active"
+
+        return dict(await asyncio.gather(*[check(thread_id) for thread_id in thread_ids]))
+
+    async def _save_archived(self, forum_id, threads, **state):
+        """写入一页归档帖，爬取进度在同一个事务里更新，中途重启也能从游标接着翻"""
+        async with get_db() as db:
+            await self._write(db, [(thread, None) for thread in threads])
+            if state: await self._save_state(db, forum_id, **state)
+            await db.commit()
+
+    async def crawl_archived(self, forum, budget):
+        """
+        收录一个论坛的归档帖，最多处理 budget 个，返回实际处理的个数。
+        先从最新往回翻到上次记下的最新归档时间（archive_newest），补上这段时间新归档的帖子；
+        历史部分还没翻完时再从游标（archive_before）继续往回翻，翻到底后标记 archive_done。
+        """
+        async with get_db() as db:
+            state = await (await db.execute(
+                "SELECT archive_before, archive_newest, archive_done FROM thread_sync_state WHERE forum_id = ?", (forum.id,)
+            )).fetchone()
+        before = state['archive_before'] if state else None
+        newest = state['archive_newest'] if state else None
+        done = bool(state and state['archive_done'])
+        crawled = 0
+
+        # 1. 上次之后新归档的帖子；预算不够没翻到水位时不动水位，下次重新从最新翻
+        if newest is not None:
+            batch, latest, caught_up = [], None, True
+            async for thread in forum.archived_threads(limit=None):
+                archived_at = _timestamp(thread.archive_timestamp)
+                if archived_at <= newest: break
+                if crawled >= budget:
+                    caught_up = False
+                    break
+                latest = latest or archived_at
+                batch.append(thread)
+                crawled += 1
+                if len(batch) >= ARCHIVE_CRAWL_PAGE_SIZE:
+                    await self._save_archived(forum.id, batch)
+                    batch = []
+            if caught_up and latest: await self._save_archived(forum.id, batch, archive_newest=latest)
+            else: await self._save_archived(forum.id, batch)
+
+        # 2. 历史归档：从游标往回翻，翻到底就算完成
+        if not done and crawled < budget:
+            batch, cursor, first, exhausted = [], before, None, True
+            start = datetime.fromtimestamp(before, timezone.utc) if before else None
+            async for thread in forum.archived_threads(limit=None, before=start):
+                if crawled >= budget:
+                    exhausted = False
+                    break
+                cursor = _timestamp(thread.archive_timestamp)
+                first = first or cursor
+                batch.append(thread)
+                crawled += 1
+                if len(batch) >= ARCHIVE_CRAWL_PAGE_SIZE:
+                    extra = {"archive_newest": first} if newest is None else {}
+                    await self._save_archived(forum.id, batch, archive_before=cursor, **extra)
+                    batch = []
+            extra = {"archive_newest": first or 0} if newest is None else {}
+            await self._save_archived(forum.id, batch, archive_before=None if exhausted else cursor, archive_done=int(exhausted), **extra)
+        return crawled
+
+    async def verify_archived(self, forum, budget):
+        """
+        向接口确认库里标记为归档的帖子是否还在，最多检查 budget 个，返回检查的个数。
+        归档帖被删除时不会出现在归档列表里，爬取发现不了，只能逐个确认：已删除的移出库，
+        已重新打开的去掉归档标记，查询失败的下一轮再确认。按帖子 ID 轮流检查，查到最后一个后从头开始。
+        """
+        async with get_db() as db:
+            state = await (await db.execute("SELECT archive_checked FROM thread_sync_state WHERE forum_id = ?", (forum.id,))).fetchone()
+            after = (state['archive_checked'] if state else None) or 0
+            rows = await (await db.execute(
+                "SELECT thread_id FROM thread_search WHERE forum_id = ? AND archived = 1 AND thread_id > ? ORDER BY thread_id LIMIT ?",
+                (forum.id, after, budget)
+            )).fetchall()
+        thread_ids = [row[0] for row in rows]
+        status = await self._check_missing(forum.guild, thread_ids)
+        async with get_db() as db:
+            await self._delete(db, [thread_id for thread_id, state in status.items() if state == "deleted"])
+            await db.executemany("UPDATE thread_search SET archived = 0 WHERE thread_id = ?",
+                                 [(thread_id,) for thread_id, state in status.items() if state == "active"])
+            await self._save_state(db, forum.id, archive_checked=thread_ids[-1] if len(thread_ids) == budget else None)
+            await db.commit()
+        return len(thread_ids)
+
+    async def load(self, guild, thread_ids):
+        """按 ID 顺序返回帖子：在网关缓存里的用 discord.Thread，其余（归档帖）用库里的 ThreadRecord"""
+        missing = [thread_id for thread_id in thread_ids if guild.get_thread(thread_id) is None]
+        records = {}
+        if missing:
+            async with get_db() as db:
+                rows = await (await db.execute(
+                    f"SELECT thread_id, forum_id, owner_id, title, created_at, archived, pinned FROM thread_search WHERE thread_id IN ({_placeholders(missing)})", missing
+                )).fetchall()
+                tags = await (await db.execute(
+                    f"SELECT thread_id, tag_id FROM thread_tags WHERE thread_id IN ({_placeholders(missing)})", missing
+                )).fetchall()
+            tag_ids = {}
+            for row in tags: tag_ids.setdefault(row['thread_id'], []).append(row['tag_id'])
+            records = {row['thread_id']: ThreadRecord(guild, row, tag_ids.get(row['thread_id'], ())) for row in rows}
+        threads = [guild.get_thread(thread_id) or records.get(thread_id) for thread_id in thread_ids]
+        return [thread for thread in threads if thread]
+
+    async def created_since(self, forum_ids, since):
+        """这些论坛里 since（时间戳）之后发的帖子 ID，新的在前"""
+        async with get_db() as db:
+            rows = await (await db.execute(
+                f"SELECT thread_id FROM thread_search WHERE forum_id IN ({_placeholders(forum_ids)}) AND created_at >= ? ORDER BY created_at DESC",
+                [*forum_ids, since]
+            )).fetchall()
+        return [row[0] for row in rows]
+
+    async def random_ids(self, forum_ids, count):
+        """从这些论坛里随机抽 count 个不重复的帖子 ID（排除置顶帖）"""
+        async with get_db() as db:
+            rows = await (await db.execute(
+                f"SELECT thread_id FROM thread_search WHERE forum_id IN ({_placeholders(forum_ids)}) AND pinned = 0 ORDER BY RANDOM() LIMIT ?",
+                [*forum_ids, count]
+            )).fetchall()
+        return [row[0] for row in rows]
+
+    async def search(self, keyword=None, forum_ids=None, tag_ids=None, owner_id=None, limit=10, offset=0):
+        """
+        返回 (当前页的帖子 ID 列表, 命中总数)。keyword 匹配标题或首楼内容（不区分大小写的子串），
+        有关键词时按相关度排序（标题命中优先），否则按发帖时间倒序；tag_ids 命中任意一个即可。
+        全文索引里英文等按词前缀匹配，查不到时（例如用 llo 查 hello）退回逐条扫描的子串匹配。
+        """
+        if keyword:
+            ids, total = await self._search(keyword, forum_ids, tag_ids, owner_id, limit, offset, use_index=True)
+            if total or not has_word_terms(keyword): return ids, total
+        return await self._search(keyword, forum_ids, tag_ids, owner_id, limit, offset, use_index=False)
+
+    @staticmethod
+    async def _search(keyword, forum_ids, tag_ids, owner_id, limit, offset, use_index):
+        joins, where, params, order_params = "", [], [], []
+        order = "s.created_at DESC"
+        if keyword:
+            # 全文索引先筛出含有全部片段的帖子，再用子串比较确认片段是连在一起的
+            query = match_query(keyword) if use_index else None
+            pattern = _like_pattern(keyword)
+            if query:
+                joins = "JOIN thread_search_fts ON thread_search_fts.rowid = s.thread_id"
+                where.append("thread_search_fts MATCH ?")
+                params.append(query)
+                order = f"bm25(thread_search_fts, {TITLE_WEIGHT}, 1.0), s.created_at DESC"
+            else:
+                # 单个汉字之类没有片段可查的关键词、或索引按词前缀查不到的，只能扫描
+                order = "s.title LIKE ? ESCAPE '\\' DESC, s.created_at DESC"
+                order_params.append(pattern)
+            where.append("(s.title LIKE ? ESCAPE '\\' OR s.content LIKE ? ESCAPE '\\')")
+            params += [pattern, pattern]
+        if forum_ids is not None:
+            where.append(f"s.forum_id IN ({_placeholders(forum_ids)})")
+            params += list(forum_ids)
+        if tag_ids:
+            where.append(f"EXISTS (SELECT 1 FROM thread_tags t WHERE t.thread_id = s.thread_id AND t.tag_id IN ({_placeholders(tag_ids)}))")
+            params += list(tag_ids)
+        if owner_id is not None:
+            where.append("s.owner_id = ?")
+            params.append(owner_id)
+        clause = f"FROM thread_search s {joins} WHERE {' AND '.join(where) or '1'}"
+        async with get_db() as db:
+            total = (await (await db.execute(f"SELECT COUNT(*) {clause}", params)).fetchone())[0]
+            rows = await (await db.execute(
+                f"SELECT s.thread_id {clause} ORDER BY {order} LIMIT ? OFFSET ?", params + order_params + [limit, offset]
+            )).fetchall() if limit else []
+        return [row[0] for row in rows], total
+
+thread_index = ThreadSearchIndex()